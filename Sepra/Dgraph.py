@@ -1,6 +1,15 @@
 import osmnx as ox
 import networkx as nx
 import pickle
+import math
+import time
+import os
+import argparse
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from geometry import save_geometry
+from build_cache import BuildCache, file_hash, fingerprint
 
 WALK_SPEED = 1.4
 BUS_SPEED = 40 / 3.6
@@ -9,6 +18,23 @@ TAXI_SPEED = 50 / 3.6
 BUS_COST = 500
 TAXI_COST = 5000
 
+MAX_WALK = 1500
+TAXI_MAX_WALK = 300
+TAXI_DROPS = 5
+EARTH_RADIUS = 6371009
+
+DRIVE_GRAPH = "Graphes/kerman_drive.graphml20"
+WALK_GRAPH = "Graphes/kerman_walk.graphml20"
+CACHE_PATH = "Graphes/build_cache.pkl"
+ARTIFACTS = [
+    "Graphes/Dgraph.graphml",
+    "Graphes/node_drive.pkl",
+    "Graphes/node_walk.pkl",
+    "Graphes/real_paths_coords.npy",
+    "Graphes/real_paths_offsets.npy",
+    "Graphes/real_paths_index.pkl",
+]
+
 bus_routes = {
     "bus1": {
         "interval": 15,
@@ -137,36 +163,120 @@ taxi_routes = [
     ("taxi_s8", "taxi_e8", 30.293668, 57.087556, 30.309915, 57.094041)
 ]
         
+G_drive = G_walk = None
+
 def create_osmGraph():
-    G_drive = ox.load_graphml("Graphes/kerman_drive.graphml20")
-    G_walk  = ox.load_graphml("Graphes/kerman_walk.graphml20")
+    G_drive = ox.load_graphml(DRIVE_GRAPH)
+    G_walk  = ox.load_graphml(WALK_GRAPH)
 
     return G_drive , G_walk
 
+def init_worker():
+    # forked workers inherit the parent's graphs, spawned ones load them once
+    global G_drive, G_walk
+    if G_drive is None:
+        G_drive , G_walk = create_osmGraph()
+
 def nearest_drive(G_drive ,lat, lon):
     return ox.nearest_nodes(G_drive, lon, lat)
 
 def nearest_walk(G_walk,lat, lon):
     return ox.nearest_nodes(G_walk, lon, lat)
 
-def walk_layer(G, D, node_osm):
-    for u in D.nodes:
-        for v in D.nodes:
-            if u == v or D.has_edge(u,v):
-                continue
-
-            dist = nx.shortest_path_length(
-            G,
-            node_osm[u],
-            node_osm[v],
-            weight="length")
-
-            if dist < 1500:
-                time = dist/WALK_SPEED
-                D.add_edge(u,v,mode="walk",distance=dist,cost=0,time=time)
-                D.add_edge(v,u,mode="walk",distance=dist,cost=0,time=time)
+# cache-keyed street computations; they read the module graphs so that
+# pool workers can run them after init_worker
+
+def walk_length(key):
+    return nx.shortest_path_length(G_walk, key[0], key[1], weight="length")
+
+def walk_ball_lengths(key):
+    return nx.single_source_dijkstra_path_length(G_walk, key[0], cutoff=key[1], weight="length")
+
+def drive_hops(key):
+    return nx.shortest_path(G_drive, key[0], key[1])
+
+def drive_length(key):
+    return nx.shortest_path_length(G_drive, key[0], key[1], weight='length')
+
+def leg_geometry(key):
+    G_use = G_walk if key[0] == 'walk' else G_drive
+    p = nx.shortest_path(G_use, key[1], key[2], weight="length")
+    return [(G_use.nodes[n]["y"], G_use.nodes[n]["x"]) for n in p]
+
+def snap_walk(G_walk, points, cache):
+    return cache.memo_many('walk_node', points, lambda missing: [
+        int(n) for n in ox.nearest_nodes(G_walk, [lon for _, lon in missing], [lat for lat, _ in missing])])
+
+def snap_drive(G_drive, points, cache):
+    return cache.memo_many('drive_node', points, lambda missing: [
+        int(n) for n in ox.nearest_nodes(G_drive, [lon for _, lon in missing], [lat for lat, _ in missing])])
+
+def walk_ball(G_walk, source, cutoff, cache):
+    return cache.memo('walk_ball', (source, cutoff), walk_ball_lengths)
+
+def haversine(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def walk_candidates(G, D, node_osm, max_walk):
+    # pairs farther apart than max_walk in a straight line can't be closer on the street
+    nodes = list(D.nodes)
+    coords = {u: (G.nodes[node_osm[u]]["y"], G.nodes[node_osm[u]]["x"]) for u in nodes}
+    result = []
+    for u in nodes:
+        lat, lon = coords[u]
+        result.append((u, [
+            v for v in nodes
+            if v != u and not D.has_edge(u, v)
+            and haversine(lat, lon, *coords[v]) < max_walk
+        ]))
+    return result
+
+def walk_layer(G, D, node_osm, cache, candidates, max_walk=MAX_WALK):
+    # one bounded search per stop instead of one full search per pair;
+    # candidates come from walk_candidates, computed once for the prefetch too
+    timings = {"prune": 0.0, "search": 0.0, "edges": 0.0}
+    searches = 0
+
+    t0 = time.perf_counter()
+    for u, near in candidates:
+        # skip pairs already linked from the other end earlier in this loop
+        near = [v for v in near if not D.has_edge(u, v)]
+        t1 = time.perf_counter()
+        timings["prune"] += t1 - t0
+        if not near:
+            t0 = t1
+            continue
+
+        lengths = walk_ball(G, node_osm[u], max_walk, cache)
+        searches += 1
+        t2 = time.perf_counter()
+        timings["search"] += t2 - t1
+
+        for v in near:
+            dist = lengths.get(node_osm[v])
+            if dist is not None and dist < max_walk:
+                time_sec = dist/WALK_SPEED
+                D.add_edge(u,v,mode="walk",distance=dist,cost=0,time=time_sec)
+                D.add_edge(v,u,mode="walk",distance=dist,cost=0,time=time_sec)
+        t0 = time.perf_counter()
+        timings["edges"] += t0 - t2
+
+    print(f"walk_layer: {D.number_of_nodes()} stops, {searches} searches, "
+          f"prune {timings['prune']:.2f}s, search {timings['search']:.2f}s, "
+          f"edges {timings['edges']:.2f}s")
+    return timings
+
+def bus_pairs(node_osm):
+    for route in bus_routes.values():
+        stops = route["stops"]
+        for i in range(len(stops) - 1):
+            yield node_osm[stops[i][0]], node_osm[stops[i + 1][0]]
 
-def bus_layer(G,G_walk,D,node_osm):
+def bus_layer(G,G_walk,D,node_osm,cache):
     for route in bus_routes.values():
         interval = route["interval"]
         stops = route["stops"]
@@ -175,12 +285,7 @@ def bus_layer(G,G_walk,D,node_osm):
             u, _, _ , start = stops[i]
             v, _, _ , start1 = stops[i + 1]
 
-            dist = nx.shortest_path_length(
-                G_walk,
-                node_osm[u],
-                node_osm[v],
-                weight="length"
-            )
+            dist = cache.memo('walk_length', (node_osm[u], node_osm[v]), walk_length)
 
             D.add_edge(
                 u,v,
@@ -201,98 +306,205 @@ def bus_layer(G,G_walk,D,node_osm):
                 start=start1
             )
 
-def taxi_layer(G_walk, D, node_drive, node_walk, taxi_routes, max_walk=300):
+def drop_points(path_drive, num_drops=TAXI_DROPS):
+    step = max(1, len(path_drive)//num_drops)
+    return path_drive[::step]
+
+def taxi_layer(G_walk, D, node_drive, node_walk, taxi_routes, cache, max_walk=TAXI_MAX_WALK):
     drops = []
     for s, e, slat, slon, elat, elon in taxi_routes:
 
-        path_drive = nx.shortest_path(G_drive, node_drive[s], node_drive[e])
-        num_drops = 5  
-        step = max(1, len(path_drive)//num_drops)
-        drop_nodes = path_drive[::step]
+        path_drive = cache.memo('drive_hops', (node_drive[s], node_drive[e]), drive_hops)
+        drop_nodes = drop_points(path_drive)
         drops += drop_nodes
 
-        for drop_node in drop_nodes:
+        points = [(G_drive.nodes[n]["y"], G_drive.nodes[n]["x"]) for n in drop_nodes]
+        for drop_node, walk_node in zip(drop_nodes, snap_walk(G_walk, points, cache)):
             D.add_node(drop_node)
-            node_walk[drop_node] = ox.nearest_nodes(G_walk, G_drive.nodes[drop_node]["x"], G_drive.nodes[drop_node]["y"])
-            node_drive[drop_node] = ox.nearest_nodes(G_drive, G_drive.nodes[drop_node]["x"], G_drive.nodes[drop_node]["y"])
+            node_walk[drop_node] = walk_node
+            node_drive[drop_node] = drop_node
 
         ls = [s] + drop_nodes + [e]
         for i in range(1 ,len(ls)):
             u , v = ls[i-1] , ls[i]
-            dist = dist = nx.shortest_path_length(G_drive, node_drive[u], node_drive[v], weight='length')
+            dist = cache.memo('drive_length', (node_drive[u], node_drive[v]), drive_length)
             time_sec = dist / TAXI_SPEED
             D.add_edge(u,v, mode='taxi', distance=dist, time=time_sec, cost=TAXI_COST)
             D.add_edge(v,u, mode='taxi', distance=dist, time=time_sec, cost=TAXI_COST)
 
-        for drop_node in drop_nodes:    
-            drop_walk_node = ox.nearest_nodes(G_walk, G_drive.nodes[drop_node]["x"], G_drive.nodes[drop_node]["y"])
-
-            for target in D.nodes:
-                if target in ls or target in drops:
-                    continue
-
-                target_walk_node = node_walk[target]
-                dist = nx.shortest_path_length(G_walk, drop_walk_node, target_walk_node, weight='length')
-                if dist <= max_walk:
-                    time_sec = dist / WALK_SPEED
-                    D.add_edge(drop_node, target, mode='walk', distance=dist, time=time_sec, cost=0)
-
-def save_real_path(D , G_walk , G_drive , node_walk , node_drive):
+        link_drops(G_walk, D, node_walk, drop_nodes, set(ls) | set(drops), max_walk, cache)
+
+def link_drops(G_walk, D, node_walk, drop_nodes, exclude, max_walk, cache):
+    # index the decision graph by walk node once, then read every target
+    # within max_walk off a single bounded search per drop
+    order = {}
+    targets = {}
+    for i, target in enumerate(D.nodes):
+        if target in exclude:
+            continue
+        order[target] = i
+        targets.setdefault(node_walk[target], []).append(target)
+
+    for drop_node in drop_nodes:
+        lengths = walk_ball(G_walk, node_walk[drop_node], max_walk, cache)
+
+        reached = [(order[t], t, dist) for n, dist in lengths.items() for t in targets.get(n, ())]
+        for _, target, dist in sorted(reached):
+            time_sec = dist / WALK_SPEED
+            D.add_edge(drop_node, target, mode='walk', distance=dist, time=time_sec, cost=0)
+
+def geometry_key(u, v, edge_data, node_walk, node_drive):
+    mode = edge_data.get('mode')
+    if mode == 'walk' or mode == 'bus':
+        return ('walk', node_walk[u], node_walk[v])
+    return ('drive', node_drive[u], node_drive[v])
+
+def save_real_path(D , G_walk , G_drive , node_walk , node_drive, cache):
     real = {}
-    for u in D.nodes:
-        for v in D.nodes:
-            if u == v or  not D.has_edge(u,v):
-                continue
-            
-            edge_data = D.get_edge_data(u, v)
-            mode = edge_data.get('mode')
-
-            if mode == 'walk' or mode == 'bus':
-                p = nx.shortest_path(G_walk, node_walk[u], node_walk[v], weight="length")
-                G_use = G_walk
-            else:
-                p = nx.shortest_path(G_drive, node_drive[u], node_drive[v], weight="length")
-                G_use = G_drive
-
-            coords = [(G_use.nodes[n]["y"], G_use.nodes[n]["x"]) for n in p]
-            real[(u,v)] = coords
-
-    with open('Graphes/real_paths.pkl', 'wb') as f:
-        pickle.dump(real, f)
-
-G_drive , G_walk = create_osmGraph()
-D = nx.DiGraph()
-
-node_drive = {}
-node_walk = {}
-
-for r in bus_routes.values():
-
-    for n, lat, lon , _ in r["stops"]:
-        D.add_node(n)
-        node_drive[n] = nearest_drive(G_drive,lat, lon)
-        node_walk[n]  = nearest_walk(G_walk,lat, lon)
-
-for s, e, slat, slon, elat, elon in taxi_routes:
-        D.add_node(s)
-        D.add_node(e)
-        node_drive[s] = nearest_drive(G_drive ,slat, slon)
-        node_drive[e] = nearest_drive(G_drive ,elat, elon)
-        node_walk[s]  = nearest_walk(G_walk ,slat, slon)
-        node_walk[e]  = nearest_walk(G_walk ,elat, elon)
-
-bus_layer(G_drive,G_walk,D,node_walk)
-
-walk_layer(G_walk,D,node_walk)
-
-taxi_layer(G_walk, D, node_drive, node_walk, taxi_routes)
-
-save_real_path(D , G_walk , G_drive , node_walk , node_drive)
-
-nx.write_graphml(D, 'Graphes/Dgraph.graphml')
-
-with open('Graphes/node_drive.pkl', 'wb') as f:
-        pickle.dump(node_drive, f)
-
-with open('Graphes/node_walk.pkl', 'wb') as f:
-        pickle.dump(node_walk, f)
\ No newline at end of file
+    for u, v, edge_data in D.edges(data=True):
+        key = geometry_key(u, v, edge_data, node_walk, node_drive)
+        real[(u,v)] = cache.memo('geometry', key, leg_geometry)
+
+    save_geometry('Graphes/real_paths', real)
+
+# the prefetch_* stages hand every uncached street search of a layer to the
+# pool; the layers themselves then run serially on cache hits, which keeps
+# node and edge order identical to a single-process build
+
+def prefetch_walk(node_walk, candidates, cache, pool, max_walk=MAX_WALK):
+    sources = [(node_walk[u], max_walk) for u, near in candidates if near]
+    cache.fill('walk_ball', sources, walk_ball_lengths, pool)
+
+def prefetch_taxi(node_drive, cache, pool, max_walk=TAXI_MAX_WALK):
+    ends = [(node_drive[s], node_drive[e]) for s, e, *_ in taxi_routes]
+    cache.fill('drive_hops', ends, drive_hops, pool)
+
+    legs, points = [], []
+    for key in ends:
+        drop_nodes = drop_points(cache.tables['drive_hops'][key])
+        ls = [key[0]] + drop_nodes + [key[1]]
+        legs += zip(ls, ls[1:])
+        points += [(G_drive.nodes[n]["y"], G_drive.nodes[n]["x"]) for n in drop_nodes]
+    cache.fill('drive_length', legs, drive_length, pool)
+
+    sources = [(n, max_walk) for n in snap_walk(G_walk, points, cache)]
+    cache.fill('walk_ball', sources, walk_ball_lengths, pool)
+
+def prefetch_geometry(D, node_walk, node_drive, cache, pool):
+    keys = [geometry_key(u, v, data, node_walk, node_drive) for u, v, data in D.edges(data=True)]
+    cache.fill('geometry', keys, leg_geometry, pool)
+
+def build_manifest():
+    # one fingerprint per stop, per route and for the build parameters;
+    # the cache tables are keyed by content, the manifest only says what moved
+    manifest = {"params": fingerprint(WALK_SPEED, BUS_SPEED, TAXI_SPEED, BUS_COST, TAXI_COST,
+                                       MAX_WALK, TAXI_MAX_WALK, TAXI_DROPS)}
+    for name, route in bus_routes.items():
+        manifest["route:" + name] = fingerprint(route["interval"], route["stops"])
+        for n, lat, lon, start in route["stops"]:
+            manifest["stop:" + n] = fingerprint(lat, lon, start)
+    for s, e, slat, slon, elat, elon in taxi_routes:
+        manifest["taxi:" + s] = fingerprint(e, slat, slon, elat, elon)
+    return manifest
+
+def write_artifact(path, dump):
+    # written beside the target and moved into place, so an interrupted build
+    # leaves the previous artifact rather than a truncated one
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        dump(f)
+    os.replace(tmp, path)
+
+timings = {}
+
+@contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    yield
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+
+def build(workers=1, force=False):
+    global G_drive, G_walk
+
+    with stage("hash"):
+        cache = BuildCache(CACHE_PATH, file_hash(DRIVE_GRAPH, WALK_GRAPH))
+        manifest = build_manifest()
+        changes = cache.changes(manifest)
+
+    if not force and cache.manifest and not any(changes.values()) and all(os.path.exists(p) for p in ARTIFACTS):
+        print("Dgraph: inputs and OSM graphs unchanged, artifacts are up to date")
+        return
+
+    if not cache.manifest:
+        print("Dgraph: no usable build cache, full build")
+    for kind, keys in changes.items():
+        if keys and cache.manifest:
+            print(f"Dgraph: {kind}: {', '.join(keys)}")
+
+    with stage("load"):
+        G_drive , G_walk = create_osmGraph()
+
+    pool = Pool(workers, initializer=init_worker) if workers > 1 else None
+    try:
+        D = nx.DiGraph()
+
+        node_drive = {}
+        node_walk = {}
+
+        with stage("snap"):
+            stops = [(n, lat, lon) for r in bus_routes.values() for n, lat, lon, _ in r["stops"]]
+            for s, e, slat, slon, elat, elon in taxi_routes:
+                stops += [(s, slat, slon), (e, elat, elon)]
+
+            points = [(lat, lon) for _, lat, lon in stops]
+            for (n, _, _), walk_node, drive_node in zip(stops, snap_walk(G_walk, points, cache), snap_drive(G_drive, points, cache)):
+                D.add_node(n)
+                node_drive[n] = drive_node
+                node_walk[n] = walk_node
+
+        with stage("bus"):
+            cache.fill('walk_length', list(bus_pairs(node_walk)), walk_length, pool)
+            bus_layer(G_drive,G_walk,D,node_walk,cache)
+
+        with stage("walk"):
+            candidates = walk_candidates(G_walk, D, node_walk, MAX_WALK)
+            prefetch_walk(node_walk, candidates, cache, pool)
+            walk_layer(G_walk,D,node_walk,cache,candidates)
+
+        with stage("taxi"):
+            prefetch_taxi(node_drive, cache, pool)
+            taxi_layer(G_walk, D, node_drive, node_walk, taxi_routes, cache)
+
+        with stage("geometry"):
+            prefetch_geometry(D, node_walk, node_drive, cache, pool)
+            save_real_path(D , G_walk , G_drive , node_walk , node_drive, cache)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with stage("write"):
+        write_artifact('Graphes/Dgraph.graphml', lambda f: nx.write_graphml(D, f))
+        write_artifact('Graphes/node_drive.pkl', lambda f: pickle.dump(node_drive, f))
+        write_artifact('Graphes/node_walk.pkl', lambda f: pickle.dump(node_walk, f))
+
+        # last, so an interrupted build is never taken for an up-to-date one
+        cache.save(manifest)
+
+    print(f"Dgraph: {D.number_of_nodes()} nodes, {D.number_of_edges()} edges, "
+          f"{cache.computed} steps recomputed, {cache.hits} cached, {workers} workers")
+    for name, sec in timings.items():
+        print(f"  {name:<10}{sec:8.2f}s")
+    print(f"  {'total':<10}{sum(timings.values()):8.2f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the decision graph artifacts in Graphes/")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes for street searches (default: all cores)")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild even if inputs and OSM graphs are unchanged")
+    args = parser.parse_args()
+    build(max(1, args.workers), args.force)
+
+if __name__ == "__main__":
+    main()
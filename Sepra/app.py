@@ -1,15 +1,19 @@
 
-from flask import Flask, request, render_template, jsonify, send_file
+from flask import Flask, Response, request, render_template, jsonify, send_file
 import sys
 import os
 import traceback
 import requests
 import json
+import time
 import re
+import math
 import pickle
+import threading
 from datetime import datetime
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Optional, Tuple, Dict, List, Any
-import networkx as nx
 
 # اضافه کردن مسیر فایل map.py
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -18,9 +22,10 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from map import (
         create_osmGraph, nearest_drive, nearest_walk,
-        add_edge_from_start_end, dijkstra, real_path,
+        add_edge_from_start_end, real_path, walk_access, transit_options, ENGINES, ARTIFACTS,
+        travel_matrix, start_pool, worker_pool, isochrone, nearby_stops,
         snap, total_cost, traffic_factor,
-        G_drive, G_walk, D,
+        G_drive, G_walk, D, R, snapshot,
         save_real, node_drive, node_walk,
         bus_routes, taxi_routes,
         WALK_SPEED, BUS_COST, TAXI_COST, WAIT_TAXI, BUS_START, BUS_END
@@ -31,13 +36,49 @@ except ImportError as e:
     print(f"⚠️ خطا در وارد کردن map.py: {e}")
     MAP_LOADED = False
     # ایجاد متغیرهای پیش‌فرض
-    G_drive = G_walk = D = None
+    G_drive = G_walk = D = R = snapshot = None
     save_real = node_drive = node_walk = {}
     bus_routes = {}
     taxi_routes = []
+    ARTIFACTS = []
+
+from route_cache import RouteCache
+from gazetteer import Gazetteer, GeocodeCache, Geocoder, load_csv, load_osm
+from batch import BatchJobs, parse_rows
 
 app = Flask(__name__)
 
+# کش نتایج /route: کلید = گره‌های نزدیک مبدأ/مقصد + دقیقه حرکت گرد شده به پایین
+# به مضرب ROUTE_CACHE_BUCKET_MIN. پیش‌فرض ۱ یعنی دقیقه دقیق، چون انتظار اتوبوس و
+# زمان سوار/پیاده شدن گزینه‌های اتوبوسی به همان دقیقه بستگی دارد. اگر بزرگ‌تر شود
+# باید بازه ۱۵ دقیقه‌ای ترافیک (traffic.BUCKET_MIN) و فاصله حرکت خطوط اتوبوس را
+# بشمارد، وگرنه یک خانه کش دو ضریب ترافیک یا دو نوبت اتوبوس را قاطی می‌کند
+ROUTE_CACHE_SIZE = 512
+ROUTE_CACHE_TTL = 15 * 60
+ROUTE_CACHE_BUCKET_MIN = 1
+
+route_cache = RouteCache(ROUTE_CACHE_SIZE, ROUTE_CACHE_TTL, ARTIFACTS)
+
+# ماتریس سفر: سقف تعداد جفت‌ها در هر درخواست
+MATRIX_MAX_PAIRS = 10000
+
+# پردازه‌های مشترک ماتریس و کارهای دسته‌ای؛ هر پردازه سرور (مثلاً هر worker در
+# gunicorn) پیش از اولین درخواست با start_workers مال خودش را fork می‌کند و تا
+# پایانش نگه می‌دارد؛ هیچ‌وقت وسط یک درخواست fork نمی‌شوند
+WORKER_PROCESSES = 4
+
+def start_workers():
+    """پردازه‌های کمکی این پردازه سرور؛ پیش از سرویس‌دهی صدا زده می‌شود (پایین همین فایل و gunicorn.conf.py)"""
+    if MAP_LOADED:
+        start_pool(WORKER_PROCESSES)
+
+# سقف بودجه زمانی نقشه دسترسی (دقیقه)
+ISOCHRONE_MAX_MIN = 60
+
+# کارهای دسته‌ای: پوشه نتایج و سقف ردیف‌های هر فایل
+BATCH_DIR = "jobs"
+BATCH_MAX_ROWS = 100000
+
 # ==================== توابع کمکی ====================
 
 def is_coordinate(input_str: str) -> Optional[Tuple[float, float]]:
@@ -90,163 +131,256 @@ def is_coordinate(input_str: str) -> Optional[Tuple[float, float]]:
     
     return None
 
-def geocode_input(user_input: str) -> Tuple[float, float]:
+# دیکشنری کامل مکان‌های کرمان
+KERMAN_LOCATIONS = {
+    # میدان‌ها
+    "میدان شهید باهنر": (30.293556, 57.085553),
+    "میدان شهدا": (30.281539, 57.084850),
+    "میدان غدیر": (30.270045, 57.093193),
+    "میدان امام": (30.290954, 57.066992),
+    "میدان امام خمینی": (30.290954, 57.066992),
+    "میدان آزادی": (30.294815, 57.057554),
+    
+    # پارک‌ها
+    "پارک ملت": (30.287257, 57.053020),
+    "پارک شهیدان": (30.292371, 57.072765),
+    "پارک مادر": (30.299178, 57.053883),
+    "پارک بانوان": (30.294815, 57.057554),
+    "پارک بهشت": (30.286805, 57.070736),
+    
+    # دانشگاه‌ها
+    "دانشگاه شهید باهنر": (30.296862, 56.980585),
+    "دانشگاه باهنر": (30.296862, 56.980585),
+    "دانشگاه آزاد کرمان": (30.305449, 57.048575),
+    "دانشگاه علوم پزشکی": (30.297584, 57.063164),
+    "دانشگاه علوم پزشکی کرمان": (30.297584, 57.063164),
+    "دانشگاه پیام نور": (30.284217, 57.038102),
+    
+    # مراکز خرید
+    "مجتمع تجاری آفتاب": (30.294815, 57.057554),
+    "بازار کرمان": (30.286805, 57.070736),
+    "مجتمع الماس": (30.283629, 57.072924),
+    "مجتمع تجاری الماس": (30.283629, 57.072924),
+    "بازار گنج": (30.292099, 57.067025),
+    
+    # ترمینال‌ها
+    "ترمینال مسافربری": (30.262750, 56.971877),
+    "ترمینال": (30.262750, 56.971877),
+    "فرودگاه کرمان": (30.258306, 57.083596),
+    "فرودگاه": (30.258306, 57.083596),
+    "ایستگاه راه آهن": (30.272900, 57.001179),
+    
+    # بیمارستان‌ها
+    "بیمارستان افضلی": (30.292099, 57.067025),
+    "بیمارستان شریعتی": (30.286805, 57.070736),
+    "بیمارستان بهارلو": (30.297584, 57.063164),
+    "بیمارستان سیدالشهدا": (30.294815, 57.057554),
+    
+    # مناطق و خیابان‌ها
+    "بلوار جمهوری": (30.284217, 57.038102),
+    "بلوار امام": (30.286904, 57.049716),
+    "خیابان شریعتی": (30.292099, 57.067025),
+    "خیابان امام": (30.286904, 57.049716),
+    "شهرک صنعتی": (30.262750, 56.971877),
+    "شهرک امام": (30.278510, 57.017524),
+    
+    # اماکن تاریخی
+    "گنبد جبلیه": (30.283629, 57.072924),
+    "باغ شاهزاده ماهان": (30.060278, 57.271111),
+    "بازار بزرگ کرمان": (30.286805, 57.070736),
+    "مسجد جامع کرمان": (30.292371, 57.072765),
+    
+    # هتل‌ها
+    "هتل پارس": (30.290954, 57.066992),
+    "هتل اخوان": (30.292099, 57.067025),
+    "هتل گنج": (30.294815, 57.057554),
+    
+    # ادارات دولتی
+    "استانداری کرمان": (30.293556, 57.085553),
+    "شهرداری کرمان": (30.290954, 57.066992),
+    "دانشگاه علوم پزشکی": (30.297584, 57.063164),
+}
+
+PLACES_CSV = "Graphes/places.csv"
+PLACES_OSM = "Graphes/places.osm"
+GEOCODE_CACHE = "Graphes/geocode_cache.json"
+
+# مبدأ و مقصد همزمان geocode می‌شوند، با یک مهلت کلی برای هر درخواست؛
+# اگر مهلت تمام شد: "center" یعنی مرکز کرمان، "error" یعنی خطای 504
+GEOCODE_DEADLINE = 8
+GEOCODE_FALLBACK = "center"
+KERMAN_CENTER = (30.2839, 57.0834)
+
+# استخر مشترک جستجوهای Nominatim؛ هر درخواست حداکثر GEOCODE_PER_REQUEST جستجو
+# را همزمان در صف دارد تا درخواست‌های دیگر پشت آن نمانند
+GEOCODE_WORKERS = 8
+GEOCODE_PER_REQUEST = 2
+geocode_pool = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS, thread_name_prefix="geocode")
+
+# هر نخ session خودش را دارد (requests.Session برای استفاده چندنخی تضمین نشده)
+# و اتصالش به Nominatim باز می‌ماند (keep-alive)
+_http = threading.local()
+
+def http_session() -> requests.Session:
+    session = getattr(_http, "session", None)
+    if session is None:
+        session = _http.session = requests.Session()
+    return session
+
+class GeocodeTimeout(Exception):
+    pass
+
+def nominatim_search(query: str) -> Optional[Tuple[float, float]]:
+    """
+    یک درخواست به Nominatim؛ None یعنی پیدا نشد، خطای شبکه بالا می‌رود
+    (تا در کش ذخیره نشود)
+    """
+    url = "https://nominatim.openstreetmap.org/search"
+    params = {
+        'q': query,
+        'format': 'json',
+        'limit': 1,
+        'accept-language': 'fa',
+        'countrycodes': 'ir',  # محدود به ایران
+        'addressdetails': 1
+    }
+    headers = {
+        'User-Agent': 'SepraRouteFinder/3.0 (contact@sepra.com)'
+    }
+    
+    response = http_session().get(url, params=params, headers=headers, timeout=GEOCODE_DEADLINE)
+    response.raise_for_status()
+    data = response.json()
+    if not data:
+        return None
+    return (float(data[0]['lat']), float(data[0]['lon']))
+
+def load_places() -> Gazetteer:
+    """مکان‌های معروف + فایل‌های اختیاری Graphes/places.csv و Graphes/places.osm"""
+    gazetteer = Gazetteer(
+        (name, lat, lon) for name, (lat, lon) in KERMAN_LOCATIONS.items()
+    )
+    if os.path.exists(PLACES_CSV):
+        gazetteer.add_many(load_csv(PLACES_CSV))
+    if os.path.exists(PLACES_OSM):
+        gazetteer.add_many(load_osm(PLACES_OSM))
+    print(f"📍 فهرست مکان‌ها: {len(gazetteer)} نام")
+    return gazetteer
+
+geocoder = Geocoder(load_places(), GeocodeCache(GEOCODE_CACHE), nominatim_search)
+
+def geocode_many(inputs: List[str], deadline: Optional[float] = GEOCODE_DEADLINE, log=print) -> List[Tuple[float, float]]:
+    """
+    همه ورودی‌ها را همزمان geocode می‌کند و حداکثر deadline ثانیه صبر می‌کند (None یعنی بی‌مهلت)؛
+    جستجویی که دیر برسد در پس‌زمینه تمام می‌شود و در کش می‌ماند. log پیام‌های geocode را می‌گیرد
+    """
+    if deadline is not None:
+        deadline = time.monotonic() + deadline
+    results = [None] * len(inputs)
+    
+    # مختصات، نام‌های فهرست محلی و جواب‌های کش‌شده بدون شبکه و بدون صف حل می‌شوند
+    remote = []
+    for k, text in enumerate(inputs):
+        if is_offline(text):
+            results[k] = geocode_input(text, log)
+        else:
+            remote.append(k)
+    
+    # بقیه با پنجره‌ای به اندازه GEOCODE_PER_REQUEST به استخر مشترک می‌روند
+    queue = iter(remote)
+    pending = {}
+    def submit_next():
+        k = next(queue, None)
+        if k is not None:
+            pending[geocode_pool.submit(geocode_input, inputs[k], log)] = k
+    for _ in range(GEOCODE_PER_REQUEST):
+        submit_next()
+    while pending:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            results[pending.pop(future)] = future.result()
+            submit_next()
+    
+    # جستجویی که دیر برسد در پس‌زمینه تمام می‌شود و در کش می‌ماند
+    for k, text in enumerate(inputs):
+        if results[k] is not None:
+            continue
+        if GEOCODE_FALLBACK == "error":
+            raise GeocodeTimeout(text)
+        log(f"⚠️ مهلت geocode برای '{text}' تمام شد، بازگشت به مرکز کرمان")
+        results[k] = KERMAN_CENTER
+    return results
+
+def nominatim_query(user_input: str) -> str:
+    # اگر کاربر "کرمان" را وارد نکرده، اضافه کن
+    if "کرمان" not in user_input and "kerman" not in user_input.lower():
+        return f"{user_input}, کرمان, ایران"
+    return user_input
+
+def is_offline(user_input: str) -> bool:
+    """آیا geocode_input بدون درخواست شبکه جواب می‌دهد؟"""
+    return (not user_input or is_coordinate(user_input) is not None
+            or geocoder.local(user_input) is not None
+            or nominatim_query(user_input) in geocoder.cache)
+
+def geocode_input(user_input: str, log=print) -> Tuple[float, float]:
     """
     ورودی کاربر را پردازش می‌کند:
     1. اگر مختصات بود، مستقیماً برمی‌گرداند
     2. اگر آدرس بود، geocode می‌کند
     3. اگر نام مکان معروف بود، از دیکشنری برمی‌گرداند
+    پیام‌ها به log می‌روند (پیش‌فرض print)
     """
     if not user_input:
-        print("⚠️ ورودی خالی است، بازگشت به مرکز کرمان")
+        log("⚠️ ورودی خالی است، بازگشت به مرکز کرمان")
         return (30.2839, 57.0834)
     
-    print(f"🔍 پردازش ورودی: '{user_input}'")
+    log(f"🔍 پردازش ورودی: '{user_input}'")
     
     # 1. بررسی آیا مختصات است
     coordinates = is_coordinate(user_input)
     if coordinates:
-        print(f"📍 تشخیص داده شد به عنوان مختصات: {coordinates}")
+        log(f"📍 تشخیص داده شد به عنوان مختصات: {coordinates}")
         return coordinates
     
-    # 2. بررسی در دیکشنری مکان‌های معروف
-    input_lower = user_input.strip().lower()
-    
-    # دیکشنری کامل مکان‌های کرمان
-    KERMAN_LOCATIONS = {
-        # میدان‌ها
-        "میدان شهید باهنر": (30.293556, 57.085553),
-        "میدان شهدا": (30.281539, 57.084850),
-        "میدان غدیر": (30.270045, 57.093193),
-        "میدان امام": (30.290954, 57.066992),
-        "میدان امام خمینی": (30.290954, 57.066992),
-        "میدان آزادی": (30.294815, 57.057554),
-        
-        # پارک‌ها
-        "پارک ملت": (30.287257, 57.053020),
-        "پارک شهیدان": (30.292371, 57.072765),
-        "پارک مادر": (30.299178, 57.053883),
-        "پارک بانوان": (30.294815, 57.057554),
-        "پارک بهشت": (30.286805, 57.070736),
-        
-        # دانشگاه‌ها
-        "دانشگاه شهید باهنر": (30.296862, 56.980585),
-        "دانشگاه باهنر": (30.296862, 56.980585),
-        "دانشگاه آزاد کرمان": (30.305449, 57.048575),
-        "دانشگاه علوم پزشکی": (30.297584, 57.063164),
-        "دانشگاه علوم پزشکی کرمان": (30.297584, 57.063164),
-        "دانشگاه پیام نور": (30.284217, 57.038102),
-        
-        # مراکز خرید
-        "مجتمع تجاری آفتاب": (30.294815, 57.057554),
-        "بازار کرمان": (30.286805, 57.070736),
-        "مجتمع الماس": (30.283629, 57.072924),
-        "مجتمع تجاری الماس": (30.283629, 57.072924),
-        "بازار گنج": (30.292099, 57.067025),
-        
-        # ترمینال‌ها
-        "ترمینال مسافربری": (30.262750, 56.971877),
-        "ترمینال": (30.262750, 56.971877),
-        "فرودگاه کرمان": (30.258306, 57.083596),
-        "فرودگاه": (30.258306, 57.083596),
-        "ایستگاه راه آهن": (30.272900, 57.001179),
-        
-        # بیمارستان‌ها
-        "بیمارستان افضلی": (30.292099, 57.067025),
-        "بیمارستان شریعتی": (30.286805, 57.070736),
-        "بیمارستان بهارلو": (30.297584, 57.063164),
-        "بیمارستان سیدالشهدا": (30.294815, 57.057554),
-        
-        # مناطق و خیابان‌ها
-        "بلوار جمهوری": (30.284217, 57.038102),
-        "بلوار امام": (30.286904, 57.049716),
-        "خیابان شریعتی": (30.292099, 57.067025),
-        "خیابان امام": (30.286904, 57.049716),
-        "شهرک صنعتی": (30.262750, 56.971877),
-        "شهرک امام": (30.278510, 57.017524),
-        
-        # اماکن تاریخی
-        "گنبد جبلیه": (30.283629, 57.072924),
-        "باغ شاهزاده ماهان": (30.060278, 57.271111),
-        "بازار بزرگ کرمان": (30.286805, 57.070736),
-        "مسجد جامع کرمان": (30.292371, 57.072765),
-        
-        # هتل‌ها
-        "هتل پارس": (30.290954, 57.066992),
-        "هتل اخوان": (30.292099, 57.067025),
-        "هتل گنج": (30.294815, 57.057554),
-        
-        # ادارات دولتی
-        "استانداری کرمان": (30.293556, 57.085553),
-        "شهرداری کرمان": (30.290954, 57.066992),
-        "دانشگاه علوم پزشکی": (30.297584, 57.063164),
-    }
+    # 2. جستجو در فهرست محلی مکان‌ها (نرمال‌سازی فارسی/عربی + تطبیق تقریبی)
+    found = geocoder.local(user_input)
+    if found:
+        name, coords = found
+        log(f"📍 یافت در فهرست محلی: '{name}' -> {coords}")
+        return coords
     
-    # جستجوی دقیق در دیکشنری
-    for name, coords in KERMAN_LOCATIONS.items():
-        name_lower = name.lower()
-        if (name_lower == input_lower or 
-            name_lower in input_lower or 
-            input_lower in name_lower):
-            print(f"📍 یافت در دیکشنری: '{name}' -> {coords}")
-            return coords
+    # 3. اگر نه مختصات بود و نه در فهرست، از Nominatim (با کش روی دیسک) استفاده کن
+    log(f"🔍 جستجوی آدرس در Nominatim: '{user_input}'")
     
-    # 3. اگر نه مختصات بود و نه در دیکشنری، از Nominatim استفاده کن
-    print(f"🔍 جستجوی آدرس در Nominatim: '{user_input}'")
+    search_query = nominatim_query(user_input)
     
     try:
-        # استفاده از Nominatim OpenStreetMap
-        url = "https://nominatim.openstreetmap.org/search"
-        
-        # اگر کاربر "کرمان" را وارد نکرده، اضافه کن
-        search_query = user_input
-        if "کرمان" not in user_input and "kerman" not in user_input.lower():
-            search_query = f"{user_input}, کرمان, ایران"
-        
-        params = {
-            'q': search_query,
-            'format': 'json',
-            'limit': 1,
-            'accept-language': 'fa',
-            'countrycodes': 'ir',  # محدود به ایران
-            'addressdetails': 1
-        }
-        
-        headers = {
-            'User-Agent': 'SepraRouteFinder/3.0 (contact@sepra.com)'
-        }
-        
-        response = requests.get(url, params=params, headers=headers, timeout=20)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                lat = float(data[0]['lat'])
-                lon = float(data[0]['lon'])
-                display_name = data[0].get('display_name', 'نامشخص')
-                
-                print(f"📍 یافت در Nominatim: {display_name[:50]}...")
-                print(f"   مختصات: ({lat:.6f}, {lon:.6f})")
-                
-                # اعتبارسنجی مختصات برگشتی
-                if 29.0 <= lat <= 31.0 and 56.0 <= lon <= 58.0:
-                    return (lat, lon)
-                else:
-                    print(f"⚠️ مختصات برگشتی خارج از محدوده کرمان")
+        coords = geocoder.search(search_query)
+        if coords:
+            lat, lon = coords
+            log(f"   مختصات: ({lat:.6f}, {lon:.6f})")
+            
+            # اعتبارسنجی مختصات برگشتی
+            if 29.0 <= lat <= 31.0 and 56.0 <= lon <= 58.0:
+                return (lat, lon)
             else:
-                print(f"⚠️ آدرس '{user_input}' در Nominatim پیدا نشد")
+                log(f"⚠️ مختصات برگشتی خارج از محدوده کرمان")
         else:
-            print(f"⚠️ خطا در ارتباط با Nominatim: {response.status_code}")
+            log(f"⚠️ آدرس '{user_input}' در Nominatim پیدا نشد")
             
     except requests.exceptions.Timeout:
-        print(f"⚠️ زمان انتظار برای Nominatim به پایان رسید")
+        log(f"⚠️ زمان انتظار برای Nominatim به پایان رسید")
     except requests.exceptions.RequestException as e:
-        print(f"⚠️ خطای شبکه در ارتباط با Nominatim: {e}")
+        log(f"⚠️ خطای شبکه در ارتباط با Nominatim: {e}")
     except Exception as e:
-        print(f"⚠️ خطای غیرمنتظره در geocoding: {e}")
+        log(f"⚠️ خطای غیرمنتظره در geocoding: {e}")
     
     # 4. اگر همه روش‌ها شکست خوردند، مرکز کرمان برگردان
-    print(f"⚠️ نتوانستیم '{user_input}' را پیدا کنیم، بازگشت به مرکز کرمان")
+    log(f"⚠️ نتوانستیم '{user_input}' را پیدا کنیم، بازگشت به مرکز کرمان")
     return (30.2839, 57.0834)
 
 def parse_time(time_str: str) -> int:
@@ -278,6 +412,13 @@ def parse_time(time_str: str) -> int:
         print(f"⚠️ خطا در تجزیه زمان: {e}")
         return 8 * 60 + 20
 
+def geocode_quiet(inputs: List[str]) -> List[Tuple[float, float]]:
+    """geocode_many برای کارهای دسته‌ای: بدون مهلت و بدون چاپ در کنسول"""
+    return geocode_many(inputs, deadline=None, log=lambda *args: None)
+
+# کارهای دسته‌ای: geocode در همین پردازه (با همان کش‌ها)، مسیریابی در پردازه‌های مشترک
+batch_jobs = BatchJobs(BATCH_DIR, geocode_quiet, parse_time, worker_pool if MAP_LOADED else None, WORKER_PROCESSES)
+
 # ==================== Routes اصلی ====================
 
 @app.route("/")
@@ -297,15 +438,17 @@ def calculate_route():
         start_input = request.form.get("start", "").strip()
         end_input = request.form.get("end", "").strip()
         start_time_str = request.form.get("start_time", "8:20").strip()
+        engine = request.form.get("engine", "dijkstra").strip()
+        # گزینه‌های اتوبوسی RAPTOR فقط در صورت درخواست (transit_options=1)
+        with_transit = request.form.get("transit_options", "").strip().lower() in ("1", "true", "yes")
         
         print(f"📝 ورودی کاربر:")
         print(f"   مبدأ: '{start_input}'")
         print(f"   مقصد: '{end_input}'")
         print(f"   زمان: '{start_time_str}'")
         
-        # تبدیل ورودی‌ها به مختصات
-        start_coords = geocode_input(start_input)
-        end_coords = geocode_input(end_input)
+        # تبدیل ورودی‌ها به مختصات (همزمان)
+        start_coords, end_coords = geocode_many([start_input, end_input])
         
         print(f"\n📌 مختصات نهایی:")
         print(f"   مبدأ: ({start_coords[0]:.6f}, {start_coords[1]:.6f})")
@@ -325,7 +468,9 @@ def calculate_route():
         result = calculate_route_with_map(
             start_coords, 
             end_coords, 
-            user_time_min
+            user_time_min,
+            engine,
+            with_transit
         )
         
         if result:
@@ -353,6 +498,12 @@ def calculate_route():
             print("❌ خطا در محاسبه مسیر، استفاده از داده تستی")
             return jsonify(get_test_data(start_coords, end_coords, user_time_min))
             
+    except GeocodeTimeout as e:
+        print(f"⏱️ مهلت geocode تمام شد: '{e}'")
+        return jsonify({
+            "error": f"مهلت geocode برای '{e}' تمام شد",
+            "message": "آدرس در زمان مقرر پیدا نشد"
+        }), 504
     except Exception as e:
         print(f"🔥 خطای عمومی در calculate_route: {e}")
         traceback.print_exc()
@@ -373,8 +524,8 @@ def calculate_route():
             "debug": {"error": str(e), "timestamp": datetime.now().isoformat()}
         }), 500
     
-def calculate_route_with_map(start_coords, end_coords, user_time_min):
-    """تابع اصلی محاسبه مسیر با map.py"""
+def calculate_route_with_map(start_coords, end_coords, user_time_min, engine="dijkstra", with_transit=False):
+    """تابع اصلی محاسبه مسیر با map.py (engine: dijkstra / csa / raptor؛ with_transit: گزینه‌های RAPTOR هم برگردد)"""
     try:
         lat, lon = start_coords
         lat1, lon1 = end_coords
@@ -387,34 +538,69 @@ def calculate_route_with_map(start_coords, end_coords, user_time_min):
         print(f"   مقصد: ({lat1:.6f}, {lon1:.6f})")
         print(f"   زمان: {user_time_min} دقیقه ({user_time_min//60}:{user_time_min%60:02d})")
             
-        # اضافه کردن گره‌های شروع و پایان
-        D.add_node("start")
-        D.add_node("end")
+        # اضافه کردن گره‌های شروع و پایان (روی نمای موقت، بدون تغییر D)
+        graph = R.overlay()
+        graph.add_node("start")
+        graph.add_node("end")
         
-        # پیدا کردن نزدیک‌ترین گره‌ها
-        node_drive["start"] = nearest_drive(G_drive, lat, lon)
-        node_walk["start"] = nearest_walk(G_walk, lat, lon)
-        node_drive["end"] = nearest_drive(G_drive, lat1, lon1)
-        node_walk["end"] = nearest_walk(G_walk, lat1, lon1)
+        # پیدا کردن نزدیک‌ترین گره‌ها (فقط برای همین درخواست، node_walk/node_drive دست نمی‌خورند)
+        walk_nodes = ChainMap({
+            "start": nearest_walk(G_walk, lat, lon),
+            "end": nearest_walk(G_walk, lat1, lon1)
+        }, node_walk)
+        drive_nodes = ChainMap({
+            "start": nearest_drive(G_drive, lat, lon),
+            "end": nearest_drive(G_drive, lat1, lon1)
+        }, node_drive)
         
         print(f"\n📍 نزدیک‌ترین گره‌ها:")
-        print(f"   پیاده مبدأ: {node_walk['start']}")
-        print(f"   رانندگی مبدأ: {node_drive['start']}")
-        print(f"   پیاده مقصد: {node_walk['end']}")
-        print(f"   رانندگی مقصد: {node_drive['end']}")
+        print(f"   پیاده مبدأ: {walk_nodes['start']}")
+        print(f"   رانندگی مبدأ: {drive_nodes['start']}")
+        print(f"   پیاده مقصد: {walk_nodes['end']}")
+        print(f"   رانندگی مقصد: {drive_nodes['end']}")
+        
+        start_access = walk_access(lat, lon)
+        end_access = walk_access(lat1, lon1)
+        if engine not in ENGINES:
+            print(f"⚠️ موتور ناشناخته '{engine}'، استفاده از dijkstra")
+            engine = "dijkstra"
+        
+        # مسیرهای تکراری (همان گره‌ها و همان بازه حرکت) از کش خوانده می‌شوند
+        cache_key = (
+            engine,
+            tuple(start_access), tuple(end_access),
+            drive_nodes["start"], drive_nodes["end"],
+            user_time_min // ROUTE_CACHE_BUCKET_MIN * ROUTE_CACHE_BUCKET_MIN,
+            with_transit
+        )
+        cached = route_cache.get(cache_key)
+        if cached is not None:
+            print(f"⚡ نتیجه از کش خوانده شد")
+            cached["map_data"]["markers"] = {
+                'start': [list(start_coords)],
+                'end': [list(end_coords)]
+            }
+            cached["debug_info"]["cache"] = "hit"
+            return cached
         
         # اضافه کردن یال‌های پیاده‌روی
-        add_edge_from_start_end(G_walk, D, node_walk)
+        add_edge_from_start_end(G_walk, graph, walk_nodes, access={
+            "start": start_access,
+            "end": end_access
+        })
         
-        # اجرای دیجکسترا
-        print(f"\n🚀 اجرای الگوریتم Dijkstra...")
-        output = dijkstra(D, 'start', 'end', user_time_min)
+        # اجرای موتور مسیریابی
+        print(f"\n🚀 اجرای الگوریتم {engine}...")
+        t0 = time.perf_counter()
+        output = ENGINES[engine](graph, 'start', 'end', user_time_min)
+        engine_ms = (time.perf_counter() - t0) * 1000
+        print(f"⏱️ زمان اجرای {engine}: {engine_ms:.3f} میلی‌ثانیه")
         
         if not output:
-            print("❌ Dijkstra مسیری پیدا نکرد")
+            print(f"❌ {engine} مسیری پیدا نکرد")
             return None
         
-        print(f"\n✅ Dijkstra اجرا شد:")
+        print(f"\n✅ {engine} اجرا شد:")
         print(f"   زمان کل: {output['time']} ثانیه ({output['time'] // 60} دقیقه)")
         print(f"   هزینه کل: {output['cost']:,} ریال")
         print(f"   تعداد مراحل: {len(output['edge_path'])}")
@@ -439,8 +625,8 @@ def calculate_route_with_map(start_coords, end_coords, user_time_min):
         # محاسبه مسیر اسنپ
         print(f"\n🚕 محاسبه مسیر مستقیم (اسنپ)...")
         snap_path, snap_cost_val , time_snap = snap(
-            node_drive["start"], 
-            node_drive["end"], 
+            drive_nodes["start"], 
+            drive_nodes["end"], 
             user_time_min
         )
         
@@ -456,8 +642,8 @@ def calculate_route_with_map(start_coords, end_coords, user_time_min):
             save_real, 
             G_walk, 
             G_drive, 
-            node_walk, 
-            node_drive
+            walk_nodes, 
+            drive_nodes
         )
         
         # اضافه کردن مسیر اسنپ به نقشه
@@ -490,12 +676,30 @@ def calculate_route_with_map(start_coords, end_coords, user_time_min):
             },
             "map_data": map_data,
             "debug_info": {
+                "engine": engine,
+                "engine_ms": round(engine_ms, 3),
                 "dijkstra_time_seconds": output['time'],
                 "edge_count": len(output['edge_path']),
-                "modes_found": modes
+                "modes_found": modes,
+                "cache": "miss"
             }
         }
         
+        # گزینه‌های اتوبوسی پارتو (زمان رسیدن در برابر تعداد تعویض)، فقط اگر خواسته شده باشد
+        if with_transit:
+            options = transit_options(graph, user_time_min)
+            print(f"🚌 گزینه‌های RAPTOR: {len(options)}")
+            result["transit_options"] = [
+                {
+                    "transfers": o["transfers"],
+                    "time": f"{int(o['arrival'] - user_time_min)} دقیقه",
+                    "arrival": f"{int(o['arrival']) // 60}:{int(o['arrival']) % 60:02d}",
+                    "lines": [leg["route"] for leg in o["legs"] if leg["mode"] == "bus"]
+                }
+                for o in options
+            ]
+        route_cache.put(cache_key, result)
+        
         print(f"\n✅ محاسبه کامل شد!")
         print("="*60)
         
@@ -585,7 +789,10 @@ def test_coordinates():
     if not address:
         return jsonify({"error": "آدرس الزامی است"}), 400
     
-    coords = geocode_input(address)
+    try:
+        coords, = geocode_many([address])
+    except GeocodeTimeout:
+        return jsonify({"error": "مهلت geocode تمام شد", "address": address}), 504
     return jsonify({
         "address": address,
         "coordinates": {
@@ -595,6 +802,180 @@ def test_coordinates():
         "is_coordinate": bool(is_coordinate(address))
     })
 
+@app.route("/matrix", methods=["POST"])
+def matrix():
+    """
+    ماتریس زمان (ثانیه) و هزینه سفر چندحالته از هر مبدأ به هر مقصد
+    بدنه JSON: origins / destinations (هر کدام [lat, lon]، نام ایستگاه یا آدرس) و start_time
+    """
+    try:
+        if not MAP_LOADED:
+            return jsonify({"error": "map.py لود نشده"}), 500
+        
+        data = request.get_json(force=True, silent=True) or {}
+        origins = matrix_points(data.get("origins", []))
+        destinations = matrix_points(data.get("destinations", []))
+        if not origins or not destinations:
+            return jsonify({"error": "origins و destinations الزامی است"}), 400
+        if len(origins) * len(destinations) > MATRIX_MAX_PAIRS:
+            return jsonify({"error": f"حداکثر {MATRIX_MAX_PAIRS} جفت مبدأ/مقصد مجاز است"}), 400
+        
+        user_time_min = parse_time(str(data.get("start_time", "8:20")))
+        
+        t0 = time.perf_counter()
+        times, costs = travel_matrix(origins, destinations, user_time_min)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        print(f"🧮 ماتریس {len(origins)}×{len(destinations)} در {elapsed_ms:.0f} میلی‌ثانیه")
+        
+        return jsonify({
+            "origins": len(origins),
+            "destinations": len(destinations),
+            "start_time_min": user_time_min,
+            "time_sec": matrix_json(times),
+            "cost": matrix_json(costs),
+            "elapsed_ms": round(elapsed_ms, 1)
+        })
+        
+    except GeocodeTimeout as e:
+        return jsonify({"error": f"مهلت geocode برای '{e}' تمام شد"}), 504
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+def matrix_points(items: List[Any]) -> List[Any]:
+    """[lat, lon] → مختصات، نام ایستگاه → همان گره، هر متن دیگر → geocode (همه با هم)"""
+    points = []
+    texts = {}
+    for k, item in enumerate(items):
+        if isinstance(item, str):
+            if item not in R.ids:
+                texts[k] = item
+            points.append(item)
+        else:
+            points.append((float(item[0]), float(item[1])))
+    
+    if texts:
+        for k, coords in zip(texts, geocode_many(list(texts.values()))):
+            points[k] = coords
+    return points
+
+def matrix_json(values) -> List[List[Optional[int]]]:
+    # nan (بدون مسیر) → null
+    return [[None if math.isnan(x) else int(round(x)) for x in row] for row in values.tolist()]
+
+@app.route("/isochrone", methods=["GET"])
+def isochrone_area():
+    """
+    محدوده‌ای که در 10/20/30 دقیقه (پیاده + اتوبوس + تاکسی) از یک نقطه می‌شود رسید
+    ورودی: lat/lon یا start (آدرس)، start_time و budgets (مثلاً 10,20,30)
+    """
+    try:
+        if not MAP_LOADED:
+            return jsonify({"error": "map.py لود نشده"}), 500
+        
+        if request.args.get("lat") and request.args.get("lon"):
+            lat, lon = float(request.args["lat"]), float(request.args["lon"])
+        else:
+            (lat, lon), = geocode_many([request.args.get("start", "")])
+        
+        user_time_min = parse_time(request.args.get("start_time", "8:20"))
+        try:
+            budgets = sorted({int(b) for b in request.args.get("budgets", "10,20,30").split(",") if b.strip()})
+        except ValueError:
+            # مقدار غیرعددی مثل budgets=10,abc هم همان خطای 400 را می‌گیرد
+            budgets = []
+        if not budgets or budgets[0] <= 0 or budgets[-1] > ISOCHRONE_MAX_MIN:
+            return jsonify({"error": f"بودجه‌ها باید بین 1 و {ISOCHRONE_MAX_MIN} دقیقه باشند"}), 400
+        
+        t0 = time.perf_counter()
+        result = isochrone(lat, lon, user_time_min, budgets)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        print(f"🕒 نقشه دسترسی {budgets} دقیقه در {elapsed_ms:.0f} میلی‌ثانیه")
+        
+        result["origin"] = [lat, lon]
+        result["start_time_min"] = user_time_min
+        result["elapsed_ms"] = round(elapsed_ms, 1)
+        return jsonify(result)
+        
+    except GeocodeTimeout as e:
+        return jsonify({"error": f"مهلت geocode برای '{e}' تمام شد"}), 504
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/batch", methods=["POST"])
+def batch_submit():
+    """
+    ثبت کار دسته‌ای: فایل CSV (origin,destination,start_time[,geometry]) یا NDJSON
+    در فیلد file یا بدنه درخواست؛ engine و geometry اختیاری. شناسه کار برمی‌گردد
+    """
+    try:
+        if not MAP_LOADED:
+            return jsonify({"error": "map.py لود نشده"}), 500
+        
+        upload = request.files.get("file")
+        text = (upload.read() if upload else request.get_data()).decode("utf-8")
+        try:
+            rows = parse_rows(text)
+        except ValueError as e:
+            return jsonify({"error": f"فایل نامعتبر: {e}"}), 400
+        if not rows:
+            return jsonify({"error": "فایل خالی است"}), 400
+        if len(rows) > BATCH_MAX_ROWS:
+            return jsonify({"error": f"حداکثر {BATCH_MAX_ROWS} ردیف مجاز است"}), 400
+        
+        engine = request.values.get("engine", "dijkstra")
+        if engine not in ENGINES:
+            return jsonify({"error": f"موتور ناشناخته: {engine}"}), 400
+        geometry = request.values.get("geometry", "").lower() in ("1", "true", "yes")
+        
+        job_id = batch_jobs.submit(rows, engine, geometry)
+        print(f"📦 کار دسته‌ای {job_id}: {len(rows)} ردیف")
+        return jsonify({"id": job_id, "total": len(rows)}), 202
+        
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/batch/<job_id>", methods=["GET"])
+def batch_status(job_id):
+    """پیشرفت کار دسته‌ای"""
+    status = batch_jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": "کار پیدا نشد"}), 404
+    return jsonify(status)
+
+@app.route("/batch/<job_id>/resume", methods=["POST"])
+def batch_resume(job_id):
+    """ادامه کاری که نیمه‌کاره مانده (مثلاً بعد از راه‌اندازی دوباره سرور)"""
+    status = batch_jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": "کار پیدا نشد"}), 404
+    if status["state"] == "done":
+        return jsonify(status)
+    if not batch_jobs.start(job_id):
+        # پردازه دیگری (یا همین پردازه) هنوز روی آن کار می‌کند
+        return jsonify({"error": "کار در حال اجراست", **batch_jobs.status(job_id)}), 409
+    return jsonify(batch_jobs.status(job_id)), 202
+
+@app.route("/batch/<job_id>/results", methods=["GET"])
+def batch_results(job_id):
+    """
+    نتایج به صورت NDJSON (هر خط یک ردیف، به ترتیب فایل)؛ تا کار تمام نشده جریان باز می‌ماند
+    offset: از ردیف چندم، follow=0: فقط آنچه تا الان آماده است
+    """
+    if batch_jobs.status(job_id) is None:
+        return jsonify({"error": "کار پیدا نشد"}), 404
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        # offset=abc هم همان خطای 400 مقدار منفی را می‌گیرد
+        offset = -1
+    if offset < 0:
+        return jsonify({"error": "offset باید عدد صحیح نامنفی باشد"}), 400
+    follow = request.args.get("follow", "1") != "0"
+    return Response(batch_jobs.stream(job_id, offset, follow), mimetype="application/x-ndjson")
+
 @app.route("/system_info", methods=["GET"])
 def system_info():
     """اطلاعات سیستم و وضعیت"""
@@ -619,17 +1000,19 @@ def system_info():
             "bus": "۲,۵۰۰ تومان",
             "taxi": "۱۵,۰۰۰ تومان",
             "snap": "متغیر"
-        }
+        },
+        "route_cache": route_cache.stats()
     }
     
     if MAP_LOADED:
         info["graph_info"] = {
-            "drive_nodes": len(G_drive.nodes()),
-            "drive_edges": len(G_drive.edges()),
-            "walk_nodes": len(G_walk.nodes()),
-            "walk_edges": len(G_walk.edges()),
-            "multimodal_nodes": len(D.nodes()),
-            "multimodal_edges": len(D.edges())
+            "drive_nodes": G_drive.number_of_nodes(),
+            "drive_edges": G_drive.number_of_edges(),
+            "walk_nodes": G_walk.number_of_nodes(),
+            "walk_edges": G_walk.number_of_edges(),
+            "multimodal_nodes": len(R),
+            "multimodal_edges": R.number_of_edges(),
+            "snapshot": snapshot is not None
         }
     
     return jsonify(info)
@@ -644,40 +1027,21 @@ def nearby_bus_stops():
         if not MAP_LOADED:
             return jsonify({"error": "map.py لود نشده"}), 500
         
-        nearest_node = nearest_walk(G_walk, lat, lon)
-        
-        # پیدا کردن نزدیک‌ترین ایستگاه‌های اتوبوس
-        bus_stops = []
-        for bus_name, bus_info in bus_routes.items():
-            for stop_name, stop_lat, stop_lon in bus_info["stops"]:
-                stop_node = nearest_walk(G_walk, stop_lat, stop_lon)
-                try:
-                    distance = nx.shortest_path_length(
-                        G_walk,
-                        nearest_node,
-                        stop_node,
-                        weight="length"
-                    )
-                    
-                    if distance < 2000:  # کمتر از 2 کیلومتر
-                        bus_stops.append({
-                            "name": stop_name,
-                            "bus": bus_name,
-                            "coordinates": [stop_lat, stop_lon],
-                            "distance_meters": int(distance),
-                            "walk_time_minutes": int(distance / (WALK_SPEED * 60))
-                        })
-                except:
-                    continue
-        
-        # مرتب‌سازی بر اساس فاصله
-        bus_stops.sort(key=lambda x: x["distance_meters"])
+        # یک جستجوی پیاده محدود به NEARBY_RADIUS از نقطه + فهرست ایستگاه‌های از پیش آماده
+        nearest_node, found, count = nearby_stops(lat, lon)
+        bus_stops = [{
+            "name": stop_name,
+            "bus": bus_name,
+            "coordinates": [stop_lat, stop_lon],
+            "distance_meters": int(distance),
+            "walk_time_minutes": int(distance / (WALK_SPEED * 60))
+        } for stop_name, bus_name, stop_lat, stop_lon, distance in found]
         
         return jsonify({
             "current_location": [lat, lon],
             "nearest_node": str(nearest_node),
-            "bus_stops": bus_stops[:10],  # فقط 10 تا نزدیک‌ترین
-            "count": len(bus_stops)
+            "bus_stops": bus_stops,  # فقط NEARBY_COUNT تا نزدیک‌ترین
+            "count": count
         })
         
     except Exception as e:
@@ -735,9 +1099,10 @@ if __name__ == "__main__":
     
     if MAP_LOADED:
         print(f"📍 اطلاعات گراف:")
-        print(f"   • رانندگی: {len(G_drive.nodes())} گره, {len(G_drive.edges())} یال")
-        print(f"   • پیاده‌روی: {len(G_walk.nodes())} گره, {len(G_walk.edges())} یال")
-        print(f"   • چندحالته: {len(D.nodes())} گره, {len(D.edges())} یال")
+        print(f"   • رانندگی: {G_drive.number_of_nodes()} گره, {G_drive.number_of_edges()} یال")
+        print(f"   • پیاده‌روی: {G_walk.number_of_nodes()} گره, {G_walk.number_of_edges()} یال")
+        print(f"   • چندحالته: {len(R)} گره, {R.number_of_edges()} یال")
+        print(f"   • بارگذاری: {'snapshot' if snapshot is not None else 'graphml'}")
         print(f"📍 خطوط اتوبوس: {len(bus_routes)} خط")
         print(f"📍 مسیرهای تاکسی: {len(taxi_routes)} مسیر")
     
@@ -748,4 +1113,10 @@ if __name__ == "__main__":
     print("💡 نکته: برای دیباگ، کنسول مرورگر (F12) و ترمینال سرور را باز نگه دارید")
     print("="*70)
     
-    app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+    # پردازه‌های کمکی همین حالا و پیش از نخ‌های سرور ساخته می‌شوند؛ در حالت debug فقط
+    # در پردازه‌ای که سرویس می‌دهد، نه پردازه ناظر reloader
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_workers()
+    
+    # هر درخواست روی نمای خودش کار می‌کند، پس چند نخ همزمان امن است
+    app.run(debug=True, port=5000, host='0.0.0.0', threaded=True)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import csv
+import fcntl
+import io
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# batch routing jobs. an uploaded file of origin/destination/departure rows
+# becomes a job directory holding the parsed rows, a status file and the
+# results as newline-delimited JSON in row order. the process running a job
+# holds an exclusive lock on the job's lock file, so every server process
+# sees whether it is running; a job that stops (server restart, crash)
+# resumes from the last complete result line.
+
+CHUNK = 256
+
+def parse_rows(text):
+    """
+    CSV with a header (origin, destination, start_time[, geometry]) or one
+    JSON object per line with the same keys
+    """
+    text = text.lstrip("﻿")
+    if text.lstrip().startswith("{"):
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    out = []
+    for row in rows:
+        if not row.get("origin") or not row.get("destination"):
+            raise ValueError(f"row {len(out) + 1}: origin and destination are required")
+        out.append({
+            "row": len(out),
+            "origin": row["origin"],
+            "destination": row["destination"],
+            "start_time": str(row.get("start_time") or "8:20"),
+            "geometry": str(row.get("geometry", "")).lower() in ("1", "true", "yes"),
+        })
+    return out
+
+def route_row(task):
+    # runs in a pool worker, where the graphs map.py loaded are already in memory
+    from map import route_pair
+
+    row, start, end, minute, engine, error = task
+    if error is not None:
+        result = {"error": error}
+    else:
+        try:
+            result = route_pair(start, end, minute, engine, row["geometry"])
+        except Exception as e:
+            result = {"error": str(e)}
+    return {"row": row["row"], "origin": row["origin"], "destination": row["destination"],
+            "start_time": row["start_time"], **result}
+
+class BatchJobs:
+    """
+    resolve_many([text]) -> [(lat, lon)] and parse_time(text) -> minute come
+    from the web app, so rows accept the same inputs as /route. rows are
+    routed on pool() (the process's long-lived pool of worker processes) or,
+    without one, in the job's own thread
+    """
+
+    def __init__(self, root, resolve_many, parse_time, pool=None, workers=1):
+        self.root = root
+        self.resolve_many = resolve_many
+        self.parse_time = parse_time
+        self.pool = pool
+        self.workers = workers
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, job_id, name):
+        return os.path.join(self.root, job_id, name)
+
+    def submit(self, rows, engine="dijkstra", geometry=False):
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(os.path.join(self.root, job_id))
+        with open(self.path(job_id, "rows.ndjson"), "w", encoding="utf-8") as f:
+            for row in rows:
+                row["geometry"] = row["geometry"] or geometry
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        open(self.path(job_id, "results.ndjson"), "w").close()
+        self._write_status(job_id, {
+            "id": job_id,
+            "engine": engine,
+            "state": "queued",
+            "total": len(rows),
+            "done": 0,
+            "failed": 0,
+            "created": datetime.now().isoformat(),
+        })
+        self.start(job_id)
+        return job_id
+
+    def start(self, job_id):
+        # also how an interrupted job resumes; a job running in any process is left alone
+        self._ensure_pool()
+        lock = self._claim(job_id)
+        if lock is None:
+            return False
+        threading.Thread(target=self._run, args=(job_id, lock), daemon=True, name=f"batch-{job_id}").start()
+        return True
+
+    def is_running(self, job_id):
+        self._ensure_pool()
+        lock = self._claim(job_id)
+        if lock is None:
+            return True
+        lock.close()
+        return False
+
+    def _ensure_pool(self):
+        # whatever pool the job will use exists before a lock file is open:
+        # workers forked while one is would hold the lock for their lifetime
+        if self.pool is not None:
+            self.pool()
+
+    def _claim(self, job_id):
+        # the job's lock file, locked; None while another runner holds it.
+        # the lock goes with the file's close, or with the process that held it
+        f = open(self.path(job_id, "lock"), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    def status(self, job_id):
+        if not os.path.exists(self.path(job_id, "status.json")):
+            return None
+        with open(self.path(job_id, "status.json"), encoding="utf-8") as f:
+            status = json.load(f)
+        if status["state"] in ("queued", "running") and not self.is_running(job_id):
+            # the process that ran it is gone; POST .../resume picks it up again
+            status["state"] = "interrupted"
+        return status
+
+    def stream(self, job_id, offset=0, follow=True, poll=0.5):
+        # result lines from offset on; while the job runs, keeps waiting for more
+        seen = 0
+        with open(self.path(job_id, "results.ndjson"), "rb") as f:
+            while True:
+                # read the state first so lines written just before the job
+                # finished are still drained below
+                active = follow and self.status(job_id)["state"] in ("queued", "running")
+                while True:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        f.seek(-len(line), os.SEEK_CUR)
+                        break
+                    if seen >= offset:
+                        yield line.decode("utf-8")
+                    seen += 1
+                if not active:
+                    break
+                time.sleep(poll)
+
+    def _write_status(self, job_id, status):
+        status["updated"] = datetime.now().isoformat()
+        tmp = self.path(job_id, "status.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(tmp, self.path(job_id, "status.json"))
+
+    def _completed(self, job_id):
+        # count complete result lines and cut a half-written last one
+        path = self.path(job_id, "results.ndjson")
+        with open(path, "rb") as f:
+            data = f.read()
+        keep = data.rfind(b"\n") + 1
+        if keep < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(keep)
+        lines = data[:keep].splitlines()
+        failed = sum(1 for line in lines if "error" in json.loads(line))
+        return len(lines), failed
+
+    def _tasks(self, rows, engine):
+        # every origin and destination of the chunk in one concurrent call
+        coords = self.resolve_many([text for row in rows for text in (row["origin"], row["destination"])])
+        tasks = []
+        for k, row in enumerate(rows):
+            try:
+                tasks.append((row, coords[2 * k], coords[2 * k + 1], self.parse_time(row["start_time"]), engine, None))
+            except Exception as e:
+                tasks.append((row, None, None, None, engine, str(e)))
+        return tasks
+
+    def _run(self, job_id, lock):
+        with lock:
+            self._route(job_id)
+
+    def _route(self, job_id):
+        with open(self.path(job_id, "status.json"), encoding="utf-8") as f:
+            status = json.load(f)
+        with open(self.path(job_id, "rows.ndjson"), encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+
+        status["done"], status["failed"] = self._completed(job_id)
+        status["state"] = "running"
+        self._write_status(job_id, status)
+
+        try:
+            with open(self.path(job_id, "results.ndjson"), "a", encoding="utf-8") as out:
+                for k in range(status["done"], len(rows), CHUNK):
+                    chunk = rows[k:k + CHUNK]
+                    # geocoding stays here: its caches live in this process
+                    tasks = self._tasks(chunk, status["engine"])
+                    pool = self.pool() if self.pool is not None else None
+                    if pool is None:
+                        results = map(route_row, tasks)
+                    else:
+                        results = pool.map(route_row, tasks, chunksize=max(1, len(tasks) // (4 * self.workers)))
+                    for result in results:
+                        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                        status["done"] += 1
+                        status["failed"] += "error" in result
+                    out.flush()
+                    self._write_status(job_id, status)
+            status["state"] = "done"
+        except Exception as e:
+            status["state"] = "error"
+            status["error"] = str(e)
+        self._write_status(job_id, status)
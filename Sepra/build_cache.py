@@ -0,0 +1,94 @@
+import hashlib
+import os
+import pickle
+
+# content-addressed memo of the expensive build steps (snapping, street
+# searches, leg geometries). keys are coordinates or OSM node ids, so an
+# entry stays valid until the OSM graphs themselves change.
+
+def file_hash(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+class BuildCache:
+    def __init__(self, path, osm_version):
+        self.path = path
+        self.osm_version = osm_version
+        self.tables = {}
+        self.manifest = {}
+        self.used = {}
+        self.fresh = {}
+        self.computed = 0
+
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('osm_version') == osm_version:
+                self.tables = data['tables']
+                self.manifest = data['manifest']
+
+    @property
+    def hits(self):
+        # keys used this run that came from the cache rather than being computed
+        return sum(len(keys - self.fresh.get(table, set())) for table, keys in self.used.items())
+
+    def memo(self, table, key, compute):
+        t = self.tables.setdefault(table, {})
+        self.used.setdefault(table, set()).add(key)
+        if key not in t:
+            self.computed += 1
+            self.fresh.setdefault(table, set()).add(key)
+            t[key] = compute(key)
+        return t[key]
+
+    def memo_many(self, table, keys, compute_many):
+        t = self.tables.setdefault(table, {})
+        self.used.setdefault(table, set()).update(keys)
+        missing = [k for k in dict.fromkeys(keys) if k not in t]
+        if missing:
+            self.computed += len(missing)
+            self.fresh.setdefault(table, set()).update(missing)
+            t.update(zip(missing, compute_many(missing)))
+        return [t[k] for k in keys]
+
+    def fill(self, table, keys, compute, pool=None, chunksize=4):
+        # compute the missing keys up front, across the pool when given;
+        # results come back in key order so the table stays deterministic
+        t = self.tables.setdefault(table, {})
+        missing = [k for k in dict.fromkeys(keys) if k not in t]
+        if missing:
+            self.computed += len(missing)
+            self.fresh.setdefault(table, set()).update(missing)
+            values = pool.map(compute, missing, chunksize) if pool is not None else map(compute, missing)
+            t.update(zip(missing, values))
+
+    def changes(self, manifest):
+        old = self.manifest
+        return {
+            'added': sorted(k for k in manifest if k not in old),
+            'removed': sorted(k for k in old if k not in manifest),
+            'changed': sorted(k for k in manifest if k in old and old[k] != manifest[k]),
+        }
+
+    def save(self, manifest):
+        # drop entries the build no longer touched (removed stops/routes)
+        self.tables = {
+            table: {k: v for k, v in t.items() if k in self.used.get(table, ())}
+            for table, t in self.tables.items()
+        }
+        self.manifest = manifest
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump({
+                'osm_version': self.osm_version,
+                'manifest': manifest,
+                'tables': self.tables,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
@@ -0,0 +1,302 @@
+import argparse
+import heapq
+import math
+import os
+import time
+import numpy as np
+
+from csr import IdIndex, Neighbors, sort_ids
+
+# contraction hierarchy over a street graph (edge weight = length). nodes are
+# contracted one by one, least important first, adding a shortcut u -> w
+# whenever u -> v -> w is the only shortest way around the contracted v.
+# a query then only climbs: forward from s and backward from t along edges
+# that lead to higher-ranked nodes, and meets at the top.
+
+WITNESS_SETTLED = 60
+
+DRIVE_GRAPHS = {
+    "Graphes/kerman_drive.graphml20": "Graphes/drive_ch.npz",
+    "Graphes/snap_drive.graphml20": "Graphes/snap_drive_ch.npz",
+}
+
+class Hierarchy:
+    def __init__(self, arrays):
+        self.__dict__.update(arrays)
+        # sorted once at build and saved, the loaded copies are read in place
+        if "id_order" not in arrays:
+            self.id_order, self.id_sorted = sort_ids(self.node_ids)
+        if "sc_order" not in arrays:
+            # shortcut (u, w) -> middle node, by binary search over u * n + w
+            self.sc_order, self.sc_keys = sort_ids(self.sc_u * len(self.node_ids) + self.sc_w)
+        # read from the (possibly shared) arrays as the query reaches each node
+        self.ids = IdIndex(self.node_ids, self.id_order, self.id_sorted)
+        self.up = Neighbors(self.up_indptr, self.up_head, self.up_weight)
+        self.down = Neighbors(self.down_indptr, self.down_head, self.down_weight)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def query(self, a, b):
+        """
+        bidirectional upward search; returns (meeting node, forward parents,
+        backward parents, length) over internal ids, or None when unreachable
+        """
+        s, t = self.ids.get(a), self.ids.get(b)
+        if s is None or t is None:
+            return None
+        if s == t:
+            return s, {s: None}, {t: None}, 0.0
+
+        dist = ({s: 0.0}, {t: 0.0})
+        parent = ({s: None}, {t: None})
+        queues = ([(0.0, s)], [(0.0, t)])
+        graphs = (self.up, self.down)
+        best, meet = math.inf, None
+
+        while queues[0] or queues[1]:
+            for side in (0, 1):
+                pq = queues[side]
+                if not pq:
+                    continue
+                d, u = heapq.heappop(pq)
+                if d > best:
+                    # nothing left on this side can improve the meeting point
+                    pq.clear()
+                    continue
+                mine, other = dist[side], dist[1 - side]
+                if d > mine[u]:
+                    continue
+                if u in other and d + other[u] < best:
+                    best, meet = d + other[u], u
+                for v, w in graphs[side][u]:
+                    nd = d + w
+                    if nd < mine.get(v, math.inf):
+                        mine[v] = nd
+                        parent[side][v] = u
+                        heapq.heappush(pq, (nd, v))
+
+        if meet is None:
+            return None
+        return meet, parent[0], parent[1], best
+
+    def path(self, a, b):
+        """
+        shortest path between two OSM nodes with the shortcuts unpacked;
+        same return as short_path, (node list, length) or (None, inf)
+        """
+        found = self.query(a, b)
+        if found is None:
+            return None, math.inf
+        meet, forward, backward, length = found
+
+        up = []
+        u = meet
+        while u is not None:
+            up.append(u)
+            u = forward[u]
+        up.reverse()
+        u = backward[meet]
+        while u is not None:
+            up.append(u)
+            u = backward[u]
+
+        nodes = [up[0]]
+        for u, w in zip(up, up[1:]):
+            self._unpack(u, w, nodes)
+        return self.node_ids[nodes].tolist(), length
+
+    def length(self, a, b):
+        found = self.query(a, b)
+        return math.inf if found is None else found[3]
+
+    def _unpack(self, u, w, out):
+        # appends the original nodes after u on the edge u -> w
+        stack = [(u, w)]
+        while stack:
+            u, w = stack.pop()
+            m = self.middle(u, w)
+            if m is None:
+                out.append(w)
+            else:
+                stack.append((m, w))
+                stack.append((u, m))
+
+    def middle(self, u, w):
+        key = u * len(self.node_ids) + w
+        k = int(np.searchsorted(self.sc_keys, key))
+        if k < len(self.sc_keys) and self.sc_keys[k] == key:
+            return int(self.sc_mid[self.sc_order[k]])
+        return None
+
+    def save(self, path):
+        # per-process name, then rename: workers building together never
+        # load a half-written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **{k: getattr(self, k) for k in ARRAYS})
+        os.replace(tmp, path)
+
+def _csr(edges, n):
+    order = sorted(range(len(edges)), key=lambda e: edges[e][0])
+    tails = np.array([edges[e][0] for e in order], dtype=np.int64)
+    indptr = np.searchsorted(tails, np.arange(n + 1)).astype(np.int64)
+    head = np.array([edges[e][1] for e in order], dtype=np.int64)
+    weight = np.array([edges[e][2] for e in order], dtype=np.float64)
+    return indptr, head, weight
+
+def _witness(out, source, skip, targets, limit):
+    # bounded dijkstra from source that ignores the node being contracted
+    dist = {source: 0.0}
+    pq = [(0.0, source)]
+    settled = 0
+    left = set(targets)
+    while pq and left and settled < WITNESS_SETTLED:
+        d, u = heapq.heappop(pq)
+        if d > dist[u]:
+            continue
+        if d > limit:
+            break
+        settled += 1
+        left.discard(u)
+        for v, w in out[u].items():
+            if v == skip:
+                continue
+            nd = d + w
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                heapq.heappush(pq, (nd, v))
+    return dist
+
+def _shortcuts(out, inn, v):
+    # the shortcuts contracting v would need right now
+    found = []
+    targets = list(out[v].items())
+    for u, wu in inn[v].items():
+        if not targets:
+            break
+        limit = wu + max(w for _, w in targets)
+        dist = _witness(out, u, v, [x for x, _ in targets], limit)
+        for x, wx in targets:
+            if x != u and dist.get(x, math.inf) > wu + wx:
+                found.append((u, x, wu + wx))
+    return found
+
+def build_hierarchy(G, weight="length"):
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    ids = {int(n): i for i, n in enumerate(node_ids)}
+    n = len(node_ids)
+
+    out = [dict() for _ in range(n)]
+    inn = [dict() for _ in range(n)]
+    for u, v, data in G.edges(data=True):
+        a, b = ids[u], ids[v]
+        w = data.get(weight, 1)
+        if a != b and w < out[a].get(b, math.inf):
+            out[a][b] = w
+            inn[b][a] = w
+
+    deleted = [0] * n
+
+    def priority(v):
+        # edge difference plus how many neighbours are already gone
+        return len(_shortcuts(out, inn, v)) - len(out[v]) - len(inn[v]) + deleted[v]
+
+    pq = [(priority(v), v) for v in range(n)]
+    heapq.heapify(pq)
+    rank = np.zeros(n, dtype=np.int64)
+    up, down, shortcuts = [], [], []
+    order = 0
+
+    while pq:
+        p, v = heapq.heappop(pq)
+        # lazy update: re-evaluate and put back if it is no longer the smallest
+        p = priority(v)
+        if pq and p > pq[0][0]:
+            heapq.heappush(pq, (p, v))
+            continue
+
+        for u, w, length in _shortcuts(out, inn, v):
+            if length < out[u].get(w, math.inf):
+                out[u][w] = length
+                inn[w][u] = length
+                shortcuts.append((u, w, v))
+
+        rank[v] = order
+        order += 1
+        # every edge v still has leads to a node contracted later (higher rank)
+        for w, length in out[v].items():
+            up.append((v, w, length))
+            del inn[w][v]
+            deleted[w] += 1
+        for u, length in inn[v].items():
+            down.append((v, u, length))
+            del out[u][v]
+            deleted[u] += 1
+        out[v], inn[v] = {}, {}
+
+    # a shortcut can later be replaced by a shorter one between the same pair;
+    # keep the middle of whichever edge survived into the hierarchy
+    kept = {(u, w): length for u, w, length in up}
+    kept.update({(u, v): length for v, u, length in down})
+    middle = {}
+    for u, w, m in shortcuts:
+        middle[(u, w)] = m
+    sc = [(u, w, m) for (u, w), m in middle.items() if (u, w) in kept]
+
+    up_indptr, up_head, up_weight = _csr(up, n)
+    down_indptr, down_head, down_weight = _csr(down, n)
+    return Hierarchy({
+        "node_ids": node_ids,
+        "rank": rank,
+        "up_indptr": up_indptr,
+        "up_head": up_head,
+        "up_weight": up_weight,
+        "down_indptr": down_indptr,
+        "down_head": down_head,
+        "down_weight": down_weight,
+        "sc_u": np.array([u for u, _, _ in sc], dtype=np.int64),
+        "sc_w": np.array([w for _, w, _ in sc], dtype=np.int64),
+        "sc_mid": np.array([m for _, _, m in sc], dtype=np.int64),
+    })
+
+ARRAYS = [
+    "node_ids", "rank",
+    "up_indptr", "up_head", "up_weight",
+    "down_indptr", "down_head", "down_weight",
+    "sc_u", "sc_w", "sc_mid", "sc_order", "sc_keys",
+    "id_order", "id_sorted",
+]
+
+def load_hierarchy(path):
+    with np.load(path) as data:
+        # files saved without the sorted keys get them computed on load
+        return Hierarchy({k: data[k] for k in ARRAYS if k in data})
+
+def load_or_build_hierarchy(G, path, source):
+    # reuse the saved hierarchy unless the graph file is newer
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        return load_hierarchy(path)
+    ch = build_hierarchy(G)
+    ch.save(path)
+    return ch
+
+def main():
+    import osmnx as ox
+
+    parser = argparse.ArgumentParser(description="contract the drive graphs ahead of serving")
+    parser.add_argument("--force", action="store_true", help="rebuild even when the saved hierarchy is current")
+    args = parser.parse_args()
+
+    for source, path in DRIVE_GRAPHS.items():
+        if not args.force and os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+            print(f"{path} is up to date")
+            continue
+        start = time.perf_counter()
+        ch = build_hierarchy(ox.load_graphml(source))
+        ch.save(path)
+        print(f"{path}: {len(ch)} nodes, {len(ch.up_head) + len(ch.down_head)} edges, "
+              f"{len(ch.sc_u)} shortcuts in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import math
+import heapq
+from bisect import bisect_left
+
+# connection scan over the same generated timetable RAPTOR uses: every trip
+# is cut into elementary connections (stop -> next stop), sorted once by
+# departure, and an earliest-arrival query is a single forward scan.
+
+class ConnectionScan:
+    def __init__(self, tt):
+        self.tt = tt
+        conns = []
+        self.trip_route = []
+        for r, route in enumerate(tt.routes):
+            deps = tt.departures[r]
+            for k in range(len(deps[0])):
+                trip = len(self.trip_route)
+                self.trip_route.append((r, k))
+                for i in range(len(route) - 1):
+                    conns.append((deps[i][k], deps[i + 1][k], route[i], route[i + 1], trip, i))
+        conns.sort(key=lambda c: (c[0], c[1]))
+
+        self.dep_time = [c[0] for c in conns]
+        self.arr_time = [c[1] for c in conns]
+        self.dep_stop = [c[2] for c in conns]
+        self.arr_stop = [c[3] for c in conns]
+        self.trip = [c[4] for c in conns]
+        self.pos = [c[5] for c in conns]
+
+    def __len__(self):
+        return len(self.dep_time)
+
+def earliest_arrival(cs, access, egress, departure):
+    """
+    access / egress map stop names to walking seconds from the origin and to
+    the destination. returns the earliest-arriving journey (same leg format as
+    raptor) or None when no stop connects the two.
+    """
+    tt = cs.tt
+    n = len(tt.stops)
+    arr = [math.inf] * n
+    labels = [None] * n
+    egress = {tt.stop_ids[s]: sec / 60 for s, sec in egress.items() if s in tt.stop_ids}
+
+    for s, sec in access.items():
+        p = tt.stop_ids.get(s)
+        if p is not None and departure + sec / 60 < arr[p]:
+            arr[p] = departure + sec / 60
+            labels[p] = ("access", sec / 60)
+    _walk(tt, arr, labels, [p for p in range(n) if labels[p] is not None])
+
+    target = min((arr[p] + m for p, m in egress.items()), default=math.inf)
+    boarded = {}
+
+    dep_time, arr_time, dep_stop, arr_stop, trips = cs.dep_time, cs.arr_time, cs.dep_stop, cs.arr_stop, cs.trip
+    for c in range(bisect_left(dep_time, departure), len(dep_time)):
+        if dep_time[c] >= target:
+            break
+        trip = trips[c]
+        if trip not in boarded:
+            if arr[dep_stop[c]] > dep_time[c]:
+                continue
+            boarded[trip] = c
+        q = arr_stop[c]
+        if arr_time[c] < arr[q]:
+            arr[q] = arr_time[c]
+            labels[q] = ("bus", trip, boarded[trip], c)
+            for p in _walk(tt, arr, labels, [q]):
+                if p in egress and arr[p] + egress[p] < target:
+                    target = arr[p] + egress[p]
+
+    best = min(egress, key=lambda p: arr[p] + egress[p], default=None)
+    if best is None or arr[best] == math.inf:
+        return None
+    legs = _legs(cs, labels, arr, best) + [{
+        "mode": "walk", "from": tt.stops[best], "to": "end",
+        "depart": arr[best], "arrive": arr[best] + egress[best],
+    }]
+    return {
+        "trips": sum(1 for leg in legs if leg["mode"] == "bus"),
+        "arrival": arr[best] + egress[best],
+        "legs": legs,
+    }
+
+def _walk(tt, arr, labels, sources):
+    # footpaths are relaxed to a fixpoint, see raptor._walk
+    heap = [(arr[p], p) for p in sources]
+    heapq.heapify(heap)
+    reached = []
+    while heap:
+        t0, p = heapq.heappop(heap)
+        if t0 > arr[p]:
+            continue
+        reached.append(p)
+        for q, minutes in tt.transfers[p]:
+            if t0 + minutes < arr[q]:
+                arr[q] = t0 + minutes
+                labels[q] = ("walk", p, minutes)
+                heapq.heappush(heap, (arr[q], q))
+    return reached
+
+def _legs(cs, labels, arr, p):
+    tt = cs.tt
+    legs = []
+    while True:
+        label = labels[p]
+        if label[0] == "access":
+            legs.append({"mode": "walk", "from": "start", "to": tt.stops[p],
+                         "depart": arr[p] - label[1], "arrive": arr[p]})
+            break
+        if label[0] == "walk":
+            _, q, minutes = label
+            legs.append({"mode": "walk", "from": tt.stops[q], "to": tt.stops[p],
+                         "depart": arr[p] - minutes, "arrive": arr[p]})
+            p = q
+            continue
+        _, trip, first, last = label
+        r, k = cs.trip_route[trip]
+        route = tt.routes[r]
+        board, alight = cs.pos[first], cs.pos[last] + 1
+        legs.append({"mode": "bus", "route": tt.route_names[r],
+                     "from": tt.stops[route[board]], "to": tt.stops[p],
+                     "stops": [tt.stops[s] for s in route[board:alight + 1]],
+                     "times": [tt.departures[r][i][k] for i in range(board, alight + 1)],
+                     "depart": tt.departures[r][board][k], "arrive": tt.departures[r][alight][k]})
+        p = route[board]
+    legs.reverse()
+    return legs
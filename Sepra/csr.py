@@ -0,0 +1,76 @@
+import numpy as np
+
+# lookups over read-only (usually memory-mapped) arrays. a dict or a list of
+# lists built from the arrays would be a private copy in every worker
+# process; these read the shared arrays on demand instead.
+
+class IdIndex:
+    """position of each id in an id array, by binary search"""
+
+    def __init__(self, ids, order=None, sorted=None):
+        # order and sorted come from sort_ids when they are saved with the
+        # ids, so a loaded index does not sort a private copy
+        ids = np.asarray(ids)
+        if order is not None:
+            self.order, self.sorted = order, sorted
+        elif len(ids) < 2 or bool((ids[1:] > ids[:-1]).all()):
+            self.order, self.sorted = None, ids
+        else:
+            self.order = np.argsort(ids, kind="stable")
+            self.sorted = ids[self.order]
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def get(self, n, default=None):
+        if not isinstance(n, (int, np.integer)):
+            return default
+        k = int(np.searchsorted(self.sorted, n))
+        if k == len(self.sorted) or self.sorted[k] != n:
+            return default
+        return k if self.order is None else int(self.order[k])
+
+    def __getitem__(self, n):
+        i = self.get(n)
+        if i is None:
+            raise KeyError(n)
+        return i
+
+    def __contains__(self, n):
+        return self.get(n) is not None
+
+    def positions(self, ids):
+        # vectorized get for ids known to be present
+        k = np.searchsorted(self.sorted, ids)
+        return k if self.order is None else self.order[k]
+
+def sort_ids(ids):
+    # (order, sorted ids) for IdIndex over unsorted ids
+    order = np.argsort(ids, kind="stable")
+    return order, np.asarray(ids)[order]
+
+class Neighbors:
+    """
+    row u of a CSR adjacency as [(head, weight)]; names translates heads
+    (and index translates u) when callers speak in ids, and without a
+    weight array the edge positions stand in for it
+    """
+
+    def __init__(self, indptr, head, weight=None, names=None, index=None):
+        self.indptr = indptr
+        self.head = head
+        self.weight = weight
+        self.names = names
+        self.index = index
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, u):
+        i = u if self.index is None else self.index[u]
+        a, b = self.indptr[i:i + 2].tolist()
+        heads = self.head[a:b]
+        if self.names is not None:
+            heads = self.names[heads]
+        weights = range(a, b) if self.weight is None else self.weight[a:b].tolist()
+        return list(zip(heads.tolist(), weights))
@@ -0,0 +1,219 @@
+import csv
+import fcntl
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+
+# offline place-name lookup. names are normalized (arabic/persian letter
+# variants, diacritics, digits, zero-width joiners) and indexed by exact
+# form and by character trigrams; anything the gazetteer cannot answer goes
+# to a remote geocoder whose answers are kept on disk.
+
+ARABIC_TO_PERSIAN = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ؤ": "و",
+    "۰": "0", "۱": "1", "۲": "2", "۳": "3", "۴": "4",
+    "۵": "5", "۶": "6", "۷": "7", "۸": "8", "۹": "9",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+    "\u200c": " ", "\u200d": "", "\u0640": "",
+})
+DIACRITICS = re.compile("[\u064b-\u065f\u0670]")
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+# a fuzzy match only forgives typos: it needs this trigram similarity and at
+# most one edit per FUZZY_EDITS characters (at least one). anything further
+# off is left to the remote geocoder rather than matched to another place
+FUZZY_THRESHOLD = 0.7
+FUZZY_EDITS = 10
+
+def normalize(text):
+    text = text.translate(ARABIC_TO_PERSIAN).lower()
+    text = DIACRITICS.sub("", text)
+    text = PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    # levenshtein distance, or limit + 1 as soon as it must exceed limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ca != cb))
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+class Gazetteer:
+    def __init__(self, places=()):
+        self.names = []
+        self.keys = []
+        self.sizes = []
+        self.coords = []
+        self.exact = {}
+        self.grams = {}
+        self.add_many(places)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_many(self, places):
+        # places are (name, lat, lon); the first entry for a name wins
+        for name, lat, lon in places:
+            key = normalize(name)
+            if not key or key in self.exact:
+                continue
+            i = len(self.names)
+            grams = trigrams(key)
+            self.names.append(name)
+            self.keys.append(key)
+            self.sizes.append(len(grams))
+            self.coords.append((float(lat), float(lon)))
+            self.exact[key] = i
+            for g in grams:
+                self.grams.setdefault(g, set()).add(i)
+
+    def lookup(self, query):
+        """
+        (name, (lat, lon)) for the best match or None: the exact name, then
+        the longest name inside the query, then the shortest name containing
+        the query (whole words in both cases), then a spelling a typo or two
+        away
+        """
+        key = normalize(query)
+        if not key:
+            return None
+        i = self.exact.get(key)
+        if i is None:
+            i = self._best(key)
+        return None if i is None else (self.names[i], self.coords[i])
+
+    def _best(self, key):
+        grams = trigrams(key)
+        counts = {}
+        for g in grams:
+            for i in self.grams.get(g, ()):
+                counts[i] = counts.get(i, 0) + 1
+
+        # a substring shares every trigram except the (up to 3) padded ones
+        # at its ends, so the counts rule out almost everything up front
+        words = f" {key} "
+        inside = [i for i, n in counts.items() if n >= self.sizes[i] - 3 and f" {self.keys[i]} " in words]
+        if inside:
+            return max(inside, key=lambda i: len(self.keys[i]))
+        around = [i for i, n in counts.items() if n >= len(grams) - 3 and words in f" {self.keys[i]} "]
+        if around:
+            return min(around, key=lambda i: (not self.keys[i].startswith(key), len(self.keys[i])))
+
+        scored = []
+        for i, n in counts.items():
+            # dice coefficient over trigram sets
+            score = 2 * n / (len(grams) + self.sizes[i])
+            if score >= FUZZY_THRESHOLD:
+                scored.append((-score, i))
+        for _, i in sorted(scored):
+            limit = max(1, max(len(key), len(self.keys[i])) // FUZZY_EDITS)
+            if edit_distance(key, self.keys[i], limit) <= limit:
+                return i
+        return None
+
+def load_csv(path):
+    # name,lat,lon with a header row
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        return [(row["name"], row["lat"], row["lon"]) for row in csv.DictReader(f) if row.get("name")]
+
+def load_osm(path):
+    # named nodes of an .osm XML extract; name:fa first, then name
+    places = []
+    for _, el in ET.iterparse(path, events=("end",)):
+        if el.tag == "node":
+            tags = {t.get("k"): t.get("v") for t in el.findall("tag")}
+            for k in ("name:fa", "name"):
+                if tags.get(k):
+                    places.append((tags[k], el.get("lat"), el.get("lon")))
+            el.clear()
+        elif el.tag in ("way", "relation"):
+            el.clear()
+    return places
+
+class GeocodeCache:
+    """
+    remote geocoder answers on disk, keyed by normalized query. a miss
+    (nothing found) is stored too, so each address is asked at most once.
+    a put appends one line to a log next to the file, which is folded into
+    the file on load; processes sharing the cache lock the log to write it
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = path + ".log"
+        self.entries = self.compact()
+
+    def compact(self):
+        # merge the log into the file and empty it; the lock keeps other
+        # processes' appends out until the merged file is in place
+        with open(self.log, "a+", encoding="utf-8") as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            entries = {}
+            if os.path.exists(self.path):
+                with open(self.path, encoding="utf-8") as f:
+                    entries = json.load(f)
+            log.seek(0)
+            lines = log.read().splitlines()
+            for line in lines:
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                entries[key] = value
+            if lines:
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+                log.truncate(0)
+        return entries
+
+    def __contains__(self, query):
+        return normalize(query) in self.entries
+
+    def get(self, query):
+        value = self.entries.get(normalize(query))
+        return tuple(value) if value else None
+
+    def put(self, query, value):
+        key, value = normalize(query), list(value) if value else None
+        self.entries[key] = value
+        with open(self.log, "a", encoding="utf-8") as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            log.write(json.dumps([key, value], ensure_ascii=False) + "\n")
+
+class Geocoder:
+    """
+    gazetteer first, then the cached remote geocoder. remote(query) returns
+    (lat, lon) or None and raises on transient failures, which are not cached;
+    tests pass a local stand-in for it
+    """
+
+    def __init__(self, gazetteer, cache, remote):
+        self.gazetteer = gazetteer
+        self.cache = cache
+        self.remote = remote
+
+    def local(self, query):
+        return self.gazetteer.lookup(query)
+
+    def search(self, query):
+        if query in self.cache:
+            return self.cache.get(query)
+        value = self.remote(query)
+        self.cache.put(query, value)
+        return value
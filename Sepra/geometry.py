@@ -0,0 +1,57 @@
+import os
+import pickle
+import numpy as np
+
+# leg geometries of the decision graph: one flat (lat, lon) float32 array,
+# an offsets array with one slot per edge id, and an index (u, v) -> edge id.
+# node names are stored as strings, the way they come back from graphml.
+
+class GeometryStore:
+    def __init__(self, coords, offsets, index):
+        self.coords = coords
+        self.offsets = offsets
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, edge):
+        u, v = edge
+        return (str(u), str(v)) in self.index
+
+    def edge_id(self, u, v):
+        return self.index.get((str(u), str(v)))
+
+    def get(self, u, v):
+        i = self.edge_id(u, v)
+        if i is None:
+            return None
+        return self.coords[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+def save_geometry(prefix, real):
+    index = {}
+    offsets = [0]
+    flat = []
+    for i, ((u, v), coords) in enumerate(real.items()):
+        index[(str(u), str(v))] = i
+        flat.extend(coords)
+        offsets.append(len(flat))
+
+    # each file is written beside its target and moved into place, so an
+    # interrupted build never leaves a truncated one behind
+    def write(path, dump):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            dump(f)
+        os.replace(tmp, path)
+
+    write(prefix + '_coords.npy', lambda f: np.save(f, np.asarray(flat, dtype=np.float32).reshape(-1, 2)))
+    write(prefix + '_offsets.npy', lambda f: np.save(f, np.asarray(offsets, dtype=np.int64)))
+    write(prefix + '_index.pkl', lambda f: pickle.dump(index, f))
+
+def load_geometry(prefix):
+    coords = np.load(prefix + '_coords.npy', mmap_mode='r')
+    offsets = np.load(prefix + '_offsets.npy', mmap_mode='r')
+    with open(prefix + '_index.pkl', 'rb') as f:
+        index = pickle.load(f)
+    return GeometryStore(coords, offsets, index)
@@ -0,0 +1,7 @@
+# gunicorn reads this file from the working directory (gunicorn -w 4 app:app)
+
+def post_worker_init(worker):
+    # each worker forks its matrix/batch pool once the app is loaded and
+    # before it accepts a request, never from inside a handler
+    from app import start_workers
+    start_workers()
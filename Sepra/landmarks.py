@@ -0,0 +1,150 @@
+import heapq
+import math
+import os
+import numpy as np
+
+from csr import IdIndex, sort_ids
+
+# ALT (A*, landmarks, triangle inequality) over a street graph. a handful of
+# landmarks are picked far apart on the graph, and the exact distances from
+# and to each of them are stored per node. for any landmark L,
+#   d(v, t) >= d(L, t) - d(L, v)   and   d(v, t) >= d(v, L) - d(t, L)
+# so the largest of those bounds is an admissible A* heuristic.
+
+NUM_LANDMARKS = 8
+UNREACHED = 1e12
+
+class Landmarks:
+    def __init__(self, arrays):
+        self.__dict__.update(arrays)
+        # sorted once at build and saved, the loaded copies are read in place
+        if "id_order" not in arrays:
+            self.id_order, self.id_sorted = sort_ids(self.node_ids)
+        self.ids = IdIndex(self.node_ids, self.id_order, self.id_sorted)
+
+    def bound(self, t):
+        # heuristic towards t, evaluated lazily for the nodes A* touches
+        j = self.ids.get(t)
+        if j is None:
+            return lambda v: 0.0
+        src, dst = self.dist_from, self.dist_to
+        src_t, dst_t = src[j], dst[j]
+        ids = self.ids
+
+        def h(v):
+            i = ids.get(v)
+            if i is None:
+                return 0.0
+            return max(float((src_t - src[i]).max()), float((dst[i] - dst_t).max()), 0.0)
+        return h
+
+    def save(self, path):
+        # per-process name, then rename: workers building together never
+        # load a half-written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **{k: getattr(self, k) for k in ARRAYS})
+        os.replace(tmp, path)
+
+def _lengths(G, source, reverse=False):
+    import networkx as nx
+
+    H = G.reverse(copy=False) if reverse else G
+    return nx.single_source_dijkstra_path_length(H, source, weight="length")
+
+def _column(lengths, ids):
+    # nodes the search does not reach get UNREACHED, see build_landmarks
+    col = np.full(len(ids), UNREACHED)
+    for n, d in lengths.items():
+        col[ids[n]] = d
+    return col
+
+def build_landmarks(G, k=NUM_LANDMARKS):
+    """
+    farthest-point selection: start from the node farthest from an arbitrary
+    one, then keep adding the node farthest from every landmark so far
+    """
+    node_ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    ids = {int(n): i for i, n in enumerate(node_ids)}
+
+    first = _lengths(G, int(node_ids[0]))
+    landmarks = [max(first, key=first.get)]
+    dist_from, dist_to = [], []
+    nearest = np.full(len(node_ids), np.inf)
+
+    while True:
+        L = landmarks[-1]
+        dist_from.append(_column(_lengths(G, L), ids))
+        dist_to.append(_column(_lengths(G, L, reverse=True), ids))
+        if len(landmarks) == k:
+            break
+        reach = np.minimum(dist_from[-1], dist_to[-1])
+        nearest = np.minimum(nearest, reach)
+        # only nodes on the landmarks' component are candidates
+        landmarks.append(int(node_ids[int(np.argmax(np.where(nearest < UNREACHED, nearest, -1)))]))
+
+    # an unreachable pair only ever yields a bound between nodes that cannot
+    # reach each other (or a negative one), so a large finite stand-in for
+    # infinity keeps the heuristic admissible without inf - inf
+    return Landmarks({
+        "node_ids": node_ids,
+        "landmarks": np.array(landmarks, dtype=np.int64),
+        "dist_from": np.array(dist_from).T.copy(),
+        "dist_to": np.array(dist_to).T.copy(),
+    })
+
+ARRAYS = ["node_ids", "landmarks", "dist_from", "dist_to", "id_order", "id_sorted"]
+
+def load_landmarks(path):
+    with np.load(path) as data:
+        # files saved without the sorted ids get them computed on load
+        return Landmarks({k: data[k] for k in ARRAYS if k in data})
+
+def load_or_build_landmarks(G, path, source):
+    # reuse the saved landmarks unless the graph file is newer
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        return load_landmarks(path)
+    lm = build_landmarks(G)
+    lm.save(path)
+    return lm
+
+def alt_path(adj, lm, a, b):
+    """
+    A* from a to b guided by the landmark bound over node -> [(neighbour,
+    length)] lists; same return as short_path, (node list, length) or
+    (None, inf) when b is unreachable
+    """
+    h = lm.bound(b) if lm is not None else (lambda v: 0.0)
+    pq = [(h(a), 0.0, a)]
+    dist = {a: 0.0}
+    prev = {a: None}
+    done = set()
+
+    while pq:
+        _, d, u = heapq.heappop(pq)
+        if u == b:
+            break
+        if u in done:
+            continue
+        done.add(u)
+
+        for v, w in adj[u]:
+            nd = d + w
+            if nd < dist.get(v, math.inf):
+                dist[v] = nd
+                prev[v] = u
+                heapq.heappush(pq, (nd + h(v), nd, v))
+
+    if b not in prev:
+        return None, math.inf
+
+    path = []
+    cur = b
+    while cur is not None:
+        path.append(cur)
+        cur = prev[cur]
+    path.reverse()
+    return path, dist[b]
+
+def alt_length(adj, lm, a, b):
+    return alt_path(adj, lm, a, b)[1]
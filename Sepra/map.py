@@ -1,10 +1,29 @@
-import osmnx as ox
 import heapq
-import networkx as nx
+import os
 import pickle
+import multiprocessing
+import threading
+from collections import ChainMap
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from geometry import load_geometry
+from spatial import load_or_build_index
+from landmarks import load_or_build_landmarks, alt_path
+from snapshot import StreetGraph, load_snapshot, SNAPSHOT
+from contraction import load_or_build_hierarchy
+from ride import RideEngine
+from stops import StopCatalogue
+from traffic import load_profile, traffic_factor, TRAFFIC_PROFILE, BUCKET_MIN, BUCKETS
+from routing_graph import RoutingGraph, RoutingView, MODES, BUS, TAXI
+from raptor import Timetable, raptor, MAX_ROUNDS
+from csa import ConnectionScan, earliest_arrival
 
 WALK_SPEED = 1.4
 
+# furthest walk from the origin to a stop, and from a stop to the destination
+ACCESS_RADIUS = 3000
+
 BUS_COST = 500
 TAXI_COST = 5000
 
@@ -12,6 +31,33 @@ WAIT_TAXI = 10 * 60
 BUS_START = 8 * 60
 BUS_END = 20 * 60 
 
+# snap origins onto the nearest street edge instead of the nearest node
+EDGE_SNAP = False
+
+# walking radius (metres) and result count for the nearby stops lookup
+NEARBY_RADIUS = 2000
+NEARBY_COUNT = 10
+
+# grid cell (metres) for isochrone rasters
+ISOCHRONE_CELL = 100
+
+# files the served graphs are loaded from. the route cache is cleared when
+# one of them changes on disk, but a running process keeps serving the
+# graphs it loaded at import: restart the workers after a rebuild
+ARTIFACTS = [
+    SNAPSHOT,
+    "Graphes/kerman_drive.graphml20",
+    "Graphes/kerman_walk.graphml20",
+    "Graphes/snap_drive.graphml20",
+    TRAFFIC_PROFILE,
+    "Graphes/Dgraph.graphml",
+    "Graphes/node_drive.pkl",
+    "Graphes/node_walk.pkl",
+    "Graphes/real_paths_coords.npy",
+    "Graphes/real_paths_offsets.npy",
+    "Graphes/real_paths_index.pkl",
+]
+
 bus_routes = {
     "bus1": {
         "interval": 10 ,
@@ -141,117 +187,353 @@ taxi_routes = [
 ]
 
 def dijkstra(G, start, end, start_time_min):
+    if not isinstance(G, RoutingView):
+        G = RoutingGraph.from_networkx(G).overlay()
+    target = G.id(end)
+    labels = [None]
+
+    for u, total_time, total_cost, label in settle(G, G.id(start), start_time_min, labels):
+        if u == target:
+            return {
+                "edge_path": edge_path(G, labels, label),
+                "time": total_time,
+                "cost": total_cost
+            }
+
+    return None
+
+def settle(G, source, start_time_min, labels):
+    # yields (node, time, cost, label) in the order nodes are settled.
+    # heap entries carry a label id instead of a copy of the path; labels
+    # holds (parent label, edge) and the path is rebuilt once at the target
+    indptr, head, modes, times, costs, intervals, starts, same_line = G.base.lists
+    n_base = len(indptr) - 1
+    extra = G.extra
+    # decision graph legs carry no road class, they use the default factors
+    factors, last = traffic.default, BUCKETS - 1
+
     pq = []
     counter = 0
-    heapq.heappush(pq, (0,0,start_time_min,counter,start,[]))
-    visited = {} 
+    heapq.heappush(pq, (0,0,start_time_min,counter,source,0))
+    visited = [None] * len(G)
+    best = [None] * len(G)
+    best[source] = 0
 
     while pq:
-        total_time,total_cost,current_time,_,u,edge_path = heapq.heappop(pq)
+        total_time,total_cost,current_time,_,u,label = heapq.heappop(pq)
 
-        if u in visited and visited[u] <= total_time:
+        if visited[u] is not None and visited[u] <= total_time:
             continue
         visited[u] = total_time
 
-        if u == end:
-            return {
-                "edge_path": edge_path,
-                "time": total_time,
-                "cost": total_cost
-            }
+        yield u, total_time, total_cost, label
 
-        for v, data in G[u].items():
-            mode = data.get("mode", "walk")
-            dist = data.get("distance", 0)
-            t = data.get('time')
-            c = data.get('cost')
-            tf = traffic_factor(current_time)
+        tf = factors[min(current_time // BUCKET_MIN, last)]
 
+        if u < n_base:
+            a, b = indptr[u], indptr[u + 1]
+            out = zip(head[a:b], modes[a:b], times[a:b], costs[a:b], intervals[a:b], starts[a:b], same_line[a:b])
+        else:
+            out = ()
 
-            if mode == "taxi":
-                t = t * tf + WAIT_TAXI
-                c = TAXI_COST
-
-            elif mode == "bus":
-                if current_time > BUS_END:
+        for edges in (out, extra.get(u, ())):
+            for v, mode, t, c, interval, bus_start, same in edges:
+                if visited[v] is not None:
                     continue
 
-                if u[4] == v[4]:
-                    t *= tf
+                if mode == TAXI:
+                    t = t * tf + WAIT_TAXI
+                    c = TAXI_COST
 
-                else:
-                    BUS_START = data.get(start , 480)
-                    BUS_INTERVAL = data.get('interval')
-                    arrival = current_time
-                    if arrival < BUS_START:
-                        wait = BUS_START - arrival
-                    else:
-                        wait = (BUS_INTERVAL - ((arrival - BUS_START) % BUS_INTERVAL)) % BUS_INTERVAL
-
-                    t = wait * 60 + t * tf
-
-            new_edge = {
-                "from": u,
-                "to": v,
-                "mode": mode,
-                "time_sec": t,
-                "cost": c
-            }   
-            counter+=1
-            heapq.heappush(
-                pq,
-                (
-                    total_time + t,
-                    total_cost + c,
-                    current_time + int(t / 60),
-                    counter,
-                    v,
-                    edge_path + [new_edge]
-                )
-            )
-            
-    return None
+                elif mode == BUS:
+                    if current_time > BUS_END:
+                        continue
 
-def short_path(G,a,b):
-    pq = []
-    heapq.heappush(pq, (0, a))
+                    if same:
+                        t *= tf
 
-    dist = {a: 0}
-    prev = {a: None}
+                    else:
+                        arrival = current_time
+                        if arrival < bus_start:
+                            wait = bus_start - arrival
+                        else:
+                            wait = (interval - ((arrival - bus_start) % interval)) % interval
+
+                        t = wait * 60 + t * tf
+
+                # an entry strictly slower than one already queued would be
+                # discarded when popped, so it never needs to be pushed
+                new_time = total_time + t
+                if best[v] is not None and best[v] < new_time:
+                    continue
+                best[v] = new_time
+
+                labels.append((label, u, v, mode, t, c))
+                counter+=1
+                heapq.heappush(
+                    pq,
+                    (
+                        new_time,
+                        total_cost + c,
+                        current_time + int(t / 60),
+                        counter,
+                        v,
+                        len(labels) - 1
+                    )
+                )
 
-    while pq:
-        cur_dist, u = heapq.heappop(pq)
+def edge_path(G, labels, label):
+    path = []
+    while label:
+        label, u, v, mode, t, c = labels[label]
+        path.append({
+            "from": G.name(u),
+            "to": G.name(v),
+            "mode": MODES[mode],
+            "time_sec": t,
+            "cost": c
+        })
+    path.reverse()
+    return path
+
+def access_egress(graph, start="start", end="end"):
+    # walking seconds from the origin / to the destination, read off the overlay
+    end_id = graph.id(end)
+    access = {graph.name(v): t for v, _, t, *_ in graph.extra.get(graph.id(start), ())}
+    egress = {graph.name(u): t for u, edges in graph.extra.items() for v, _, t, *_ in edges if v == end_id}
+    return access, egress
+
+def transit_options(graph, start_time_min, max_rounds=MAX_ROUNDS):
+    access, egress = access_egress(graph)
+    return raptor(timetable, access, egress, start_time_min, max_rounds)
+
+def journey_edge_path(journey, start_time_min):
+    # timetable journeys in dijkstra's output format; waiting for a bus is
+    # charged to its first hop, like the bus wait in dijkstra
+    edges, clock = [], start_time_min
+    for leg in journey["legs"]:
+        if leg["mode"] == "bus":
+            for u, v, t in zip(leg["stops"], leg["stops"][1:], leg["times"][1:]):
+                edges.append({"from": u, "to": v, "mode": "bus", "time_sec": (t - clock) * 60, "cost": BUS_COST})
+                clock = t
+        else:
+            edges.append({"from": leg["from"], "to": leg["to"], "mode": "walk",
+                          "time_sec": (leg["arrive"] - clock) * 60, "cost": 0})
+            clock = leg["arrive"]
+
+    return {
+        "edge_path": edges,
+        "time": (clock - start_time_min) * 60,
+        "cost": sum(e["cost"] for e in edges)
+    }
 
-        if u == b:
-            break
+def csa(G, start, end, start_time_min):
+    access, egress = access_egress(G, start, end)
+    journey = earliest_arrival(connections, access, egress, start_time_min)
+    return journey_edge_path(journey, start_time_min) if journey else None
+
+def raptor_route(G, start, end, start_time_min):
+    access, egress = access_egress(G, start, end)
+    journeys = raptor(timetable, access, egress, start_time_min)
+    return journey_edge_path(journeys[-1], start_time_min) if journeys else None
+
+# interchangeable engines for calculate_route_with_map; the timetable
+# engines (csa, raptor) cover walk + bus only
+ENGINES = {
+    "dijkstra": dijkstra,
+    "csa": csa,
+    "raptor": raptor_route,
+}
 
-        if cur_dist > dist.get(u, float("inf")):
+def matrix_access(points, reverse=False):
+    """
+    stop -> walking seconds for each origin (or, reversed, destination).
+    a point is a (lat, lon) pair or the name of a decision-graph node,
+    which is then its own access with no walk
+    """
+    coords = [p for p in points if not isinstance(p, str)]
+    if EDGE_SNAP:
+        snapped = [walk_access(lat, lon) for lat, lon in coords]
+    else:
+        snapped = [[(n, 0)] for n in walk_index.nearest_many([p[0] for p in coords], [p[1] for p in coords])]
+    snapped = iter(snapped)
+
+    out = []
+    for p in points:
+        if isinstance(p, str):
+            out.append({p: 0.0} if p in R.ids else {})
             continue
+        dist = stop_distances(G_walk, node_walk, R.names, next(snapped), reverse=reverse)
+        out.append({s: d / WALK_SPEED for s, d in dist.items()})
+    return out
+
+def matrix_rows(access, egress, start_time_min):
+    # one multi-target search per origin; destinations are virtual nodes
+    # fed by their egress walks, so no path or geometry is ever built
+    times = np.full((len(access), len(egress)), np.nan)
+    costs = np.full((len(access), len(egress)), np.nan)
+    for i, acc in enumerate(access):
+        graph = R.overlay()
+        graph.add_node("start")
+        for s, t in acc.items():
+            graph.add_edge("start", s, mode="walk", time=t)
+        targets = {}
+        for j, egr in enumerate(egress):
+            end = f"end:{j}"
+            graph.add_node(end)
+            targets[graph.id(end)] = j
+            for s, t in egr.items():
+                graph.add_edge(s, end, mode="walk", time=t)
+
+        left = len(targets)
+        for u, total_time, total_cost, _ in settle(graph, graph.id("start"), start_time_min, [None]):
+            j = targets.get(u)
+            if j is not None:
+                times[i, j] = total_time
+                costs[i, j] = total_cost
+                left -= 1
+                if not left:
+                    break
+    return times, costs
+
+def _matrix_chunk(args):
+    return matrix_rows(*args)
+
+# forked worker processes that inherit the loaded graphs, shared by /matrix
+# and batch jobs. start_pool() forks them in the process that serves
+# requests, before it serves any (app.py's __main__, gunicorn.conf.py), and
+# they live as long as that process. nothing forks them on first use: a
+# fork from a request or job thread would copy whatever that process holds
+# at the moment, a lock another thread took or an open file such as a batch
+# job's lock, into workers that outlive it. a pool inherited through a fork
+# (gunicorn --preload, the flask reloader) is the parent's, its manager
+# thread was not copied, so worker_pool() does not hand it out
+pool = None
+pool_pid = None
+pool_size = 0
+
+def start_pool(workers):
+    global pool, pool_pid, pool_size
+    if workers > 1 and pool_pid != os.getpid():
+        # built first so the workers inherit it instead of each loading the snap graph
+        ride_engine()
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+        # a fork pool starts all its workers on the first task
+        pool.submit(int).result()
+        pool_size = workers
+        pool_pid = os.getpid()
+    return worker_pool()
+
+def worker_pool():
+    # this process's pool, or None when it has none; callers then run in-thread
+    return pool if pool_pid == os.getpid() else None
+
+def travel_matrix(origins, destinations, start_time_min):
+    """
+    door-to-door seconds and cost from every origin to every destination
+    (nan where unreachable). access legs are searched once per point and
+    shared by all pairs; origins are split across the worker pool
+    """
+    access = matrix_access(origins)
+    egress = matrix_access(destinations, reverse=True)
+    # a handful of origins is faster than a round trip to the pool
+    pool = worker_pool()
+    if pool is None or len(access) < 2 * pool_size:
+        return matrix_rows(access, egress, start_time_min)
+
+    # workers already hold the graphs, only the access dicts travel
+    step = -(-len(access) // pool_size)
+    chunks = [(access[k:k + step], egress, start_time_min) for k in range(0, len(access), step)]
+    parts = list(pool.map(_matrix_chunk, chunks))
+    return np.vstack([t for t, _ in parts]), np.vstack([c for _, c in parts])
+
+def isochrone(lat, lon, start_time_min, budgets=(10, 20, 30), cell=ISOCHRONE_CELL):
+    """
+    area reachable within each budget (minutes) by walk + bus + taxi.
+    one time-dependent search over the decision graph from the walk-reached
+    stops, then the rest of the budget is walked on from every node it
+    reached; the result is a grid of arrival minutes plus one GeoJSON
+    multipolygon per budget
+    """
+    limit = max(budgets) * 60
+    radius = limit * WALK_SPEED
+    sources = walk_access(lat, lon)
+
+    graph = R.overlay()
+    graph.add_node("start")
+    for s, dist in stop_distances(G_walk, node_walk, R.names, sources).items():
+        graph.add_edge("start", s, mode="walk", distance=dist, time=dist / WALK_SPEED)
+
+    # every decision-graph node reached in time seeds the final walk
+    n_base = len(R)
+    for u, total_time, _, _ in settle(graph, graph.id("start"), start_time_min, [None]):
+        if total_time > limit:
+            break
+        if u < n_base and R.osm_walk[u] >= 0:
+            sources.append((int(R.osm_walk[u]), total_time * WALK_SPEED))
+
+    reached = bounded_lengths(G_walk, sources, radius)
+    nodes = list(reached)
+    minutes = np.array([reached[n] for n in nodes]) / WALK_SPEED / 60
+    x, y = walk_index.project(*G_walk.coords(nodes))
+
+    # earliest arrival per grid cell
+    x0, y0 = x.min(), y.min()
+    cols = int((x.max() - x0) // cell) + 1
+    rows = int((y.max() - y0) // cell) + 1
+    grid = np.full(rows * cols, np.inf)
+    np.minimum.at(grid, ((y - y0) // cell).astype(int) * cols + ((x - x0) // cell).astype(int), minutes)
+    grid = grid.reshape(rows, cols)
+
+    features = []
+    for budget in sorted(budgets, reverse=True):
+        polygons = []
+        inside = grid <= budget
+        for r in range(rows):
+            # runs of reachable cells in a row become one rectangle
+            row = np.concatenate(([False], inside[r], [False]))
+            edges = np.flatnonzero(row[1:] != row[:-1])
+            for a, b in zip(edges[::2], edges[1::2]):
+                (s_lat, w_lon), (n_lat, e_lon) = (
+                    walk_index.unproject(x0 + a * cell, y0 + r * cell),
+                    walk_index.unproject(x0 + b * cell, y0 + (r + 1) * cell),
+                )
+                ring = [[w_lon, s_lat], [e_lon, s_lat], [e_lon, n_lat], [w_lon, n_lat], [w_lon, s_lat]]
+                polygons.append([[[float(p), float(q)] for p, q in ring]])
+        features.append({
+            "type": "Feature",
+            "properties": {"minutes": budget, "cells": int(inside.sum())},
+            "geometry": {"type": "MultiPolygon", "coordinates": polygons},
+        })
+
+    south, west = walk_index.unproject(x0, y0)
+    return {
+        "type": "FeatureCollection",
+        "features": features,
+        "raster": {
+            "south_west": [float(south), float(west)],
+            "cell_m": cell,
+            "rows": rows,
+            "cols": cols,
+            "minutes": [[None if m == np.inf else round(m, 1) for m in row] for row in grid.tolist()],
+        },
+    }
 
-        for v, edges in G[u].items():
-
-            edge = list(edges.values())[0]
-            w = edge.get('length', 1)
-            nd = cur_dist + w
-
-            if nd < dist.get(v, float("inf")):
-                dist[v] = nd
-                prev[v] = u
-                heapq.heappush(pq, (nd, v))
-
-    if b not in prev:
-        return None, float("inf")
+def short_path(G,a,b,lm=None):
+    # A* with the landmark bound; plain dijkstra when lm is None
+    return alt_path(flat_adjacency(G), lm, a, b)
 
-    path = []
-    cur = b
-    while cur:
-        path.append(cur)
-        cur = prev[cur]
-    path.reverse()
+def street_path(G, a, b):
+    # drive legs go through the contraction hierarchy, walk legs through ALT
+    if G is G_drive:
+        return drive_ch.path(a, b)
+    return short_path(G, a, b, walk_landmarks if G is G_walk else None)
 
-    return path, dist[b]
-        
 def create_osmGraph():
+    # only without a current snapshot; osmnx and networkx are slow to import
+    import osmnx as ox
+    import networkx as nx
+
     G_drive = ox.load_graphml("Graphes/kerman_drive.graphml20")
     G_walk  = ox.load_graphml("Graphes/kerman_walk.graphml20")
     D = nx.read_graphml('Graphes/Dgraph.graphml')
@@ -259,79 +541,173 @@ def create_osmGraph():
     return G_drive , G_walk ,D
 
 def nearest_drive(G_drive,lat, lon):
-    return ox.nearest_nodes(G_drive, lon, lat)
+    return drive_index.nearest(lat, lon)
 
 def nearest_walk(G_walk,lat, lon):
-    return ox.nearest_nodes(G_walk, lon, lat)
-
-def add_edge_from_start_end(G, D, node_osm):
+    return walk_index.nearest(lat, lon)
+
+def walk_access(lat, lon):
+    # (walk node, metres already walked to reach it) pairs for a point
+    if not EDGE_SNAP:
+        return [(walk_index.nearest(lat, lon), 0)]
+    snap = walk_index.nearest_edge(lat, lon)
+    # the walk out to the street, then along the edge to either end
+    return [(snap["u"], snap["distance"] + snap["to_u"]), (snap["v"], snap["distance"] + snap["to_v"])]
+
+def add_edge_from_start_end(G, D, node_osm, access=None):
+    # one bounded search out of the origin and one backwards into the
+    # destination; every stop within reach is read off the settled set
     stops = [n for n in D.nodes if n not in ["start", "end"]]
-
+    if access is None:
+        access = {"start": [(node_osm["start"], 0)], "end": [(node_osm["end"], 0)]}
+
+    for s, dist in stop_distances(G, node_osm, stops, access["start"]).items():
+        time = dist/WALK_SPEED
+        D.add_edge("start",s,mode="walk",distance=dist,cost=0,time=time)
+
+    for s, dist in stop_distances(G, node_osm, stops, access["end"], reverse=True).items():
+        time = dist/WALK_SPEED
+        D.add_edge(s,"end",mode="walk",distance=dist,cost=0,time=time)
+
+def stop_distances(G, node_osm, stops, sources, reverse=False):
+    # walking metres from the sources to every stop within ACCESS_RADIUS
+    # (or from every such stop to them, with reverse=True)
+    lengths = bounded_lengths(G, sources, ACCESS_RADIUS, reverse=reverse)
+    out = {}
     for s in stops:
-        try:
-            dist = nx.shortest_path_length(
-                G,
-                node_osm["start"],
-                node_osm[s],
-                weight="length")
-        except KeyError:
+        if reverse:
+            try:
+                osm = osm_node(node_osm, s)
+            except (KeyError, ValueError):
+                continue
+        else:
+            osm = node_osm.get(s)
+        dist = lengths.get(osm)
+        if dist is not None and dist < ACCESS_RADIUS:
+            out[s] = dist
+    return out
+
+def bounded_lengths(G, sources, cutoff, weight="length", reverse=False):
+    """
+    street distances from (node, metres already walked) sources to every node
+    closer than cutoff; with reverse=True, distances from every node to them
+    """
+    if isinstance(G, StreetGraph) and weight == "length":
+        return G.bounded_lengths(sources, cutoff, reverse)
+    adj = flat_adjacency(G, reverse, weight)
+    dist = {}
+    pq = [(off, n) for n, off in sources]
+    heapq.heapify(pq)
+    while pq:
+        d, u = heapq.heappop(pq)
+        if u in dist:
             continue
-        if dist < 3000:
-            time = dist/WALK_SPEED
-            D.add_edge("start",s,mode="walk",distance=dist,cost=0,time=time)
-
-    for s in stops:
-        try:
-            dist = nx.shortest_path_length(
-                G,
-                node_osm[s],
-                node_osm["end"],
-                weight="length")
-        except KeyError:
-            dist = nx.shortest_path_length(
-                G,
-                node_osm[int(s)],
-                node_osm["end"],
-                weight="length")
-        if dist < 3000:
-            time = dist/WALK_SPEED
-            D.add_edge(s,"end",mode="walk",distance=dist,cost=0,time=time)
+        dist[u] = d
+        for v, w in adj[u]:
+            if v in dist:
+                continue
+            nd = d + w
+            if nd < cutoff:
+                heapq.heappush(pq, (nd, v))
+    return dist
+
+_flat = {}
+
+def flat_adjacency(G, reverse=False, weight="length"):
+    # neighbour lists with parallel edges collapsed to the shortest one,
+    # built on first use and kept for as long as the graph is the same object
+    key = (id(G), reverse, weight)
+    cached = _flat.get(key)
+    if cached is None or cached[0] is not G:
+        if isinstance(G, StreetGraph):
+            # snapshot graphs are stored collapsed, by length
+            adj = G.adjacency(reverse)
+        else:
+            nbrs = G.pred if reverse else G.succ
+            adj = {
+                u: [(v, min(e.get(weight, 1) for e in edges.values())) for v, edges in out.items()]
+                for u, out in nbrs.items()
+            }
+        cached = _flat[key] = (G, adj)
+    return cached[1]
+
+def nearby_stops(lat, lon, radius=NEARBY_RADIUS, k=NEARBY_COUNT):
+    """
+    the k bus stops closest on foot within radius metres: (walk node of
+    the point, [(name, line, lat, lon, metres)], stops within radius)
+    """
+    source = walk_index.nearest(lat, lon)
+    lengths = bounded_lengths(G_walk, [(source, 0)], radius)
+    found, dist, count = stop_catalogue.nearest(lat, lon, source, lengths, radius, k)
+    c = stop_catalogue
+    stops = [(c.names[i], c.lines[i], float(c.lat[i]), float(c.lon[i]), d) for i, d in zip(found.tolist(), dist.tolist())]
+    return source, stops, count
+
+def osm_node(node_osm, n):
+    try:
+        return node_osm[n]
+    except KeyError:
+        return node_osm[int(n)]
 
 def real_path(edge_path , save_real , G_walk , G_drive , node_walk , node_drive):
     real = {}
     for edge in edge_path:
-        if (edge['from'],edge['to']) in save_real.keys():
-            p = save_real[(edge['from'] ,edge['to'])]
+        coords = save_real.get(edge['from'], edge['to'])
 
-        if edge['mode'] == 'walk' or edge['mode'] == 'bus':
-            try:
-                p = nx.shortest_path(G_walk, node_walk[edge['from']], node_walk[edge['to']], weight="length")
-                G_use = G_walk
-            except:
-                p = nx.shortest_path(G_walk, node_walk[edge['from']], node_walk[int(edge['to'])], weight="length")
-                G_use = G_walk
-        else:
-            p = nx.shortest_path(G_drive, node_drive[edge['from']], node_drive[edge['to']], weight="length")
-            G_use = G_drive
+        if coords is None:
+            if edge['mode'] == 'walk' or edge['mode'] == 'bus':
+                G_use, node_osm = G_walk, node_walk
+            else:
+                G_use, node_osm = G_drive, node_drive
+
+            p, _ = street_path(G_use, osm_node(node_osm, edge['from']), osm_node(node_osm, edge['to']))
+            coords = [(G_use.nodes[n]["y"], G_use.nodes[n]["x"]) for n in p or ()]
 
-        coords = [(G_use.nodes[n]["y"], G_use.nodes[n]["x"]) for n in p]
         real.setdefault(edge['mode'], []).append(coords)
 
     return real
 
 def snap(start , end , time):
-    G = ox.load_graphml("Graphes/snap_drive.graphml20")
-    p , dist = short_path(G,start,end)
-
-    tf = traffic_factor(time)
-    travel_time_sec = dist / 10 * tf
+    p , dist , travel_time_sec = ride_engine().route(start, end, time)
 
     total_cost = travel_time_sec + dist/1000 * 15000
 
-    p = [(G.nodes[n]["y"], G.nodes[n]["x"]) for n in p]
-    
     return p , total_cost / 2.5 , travel_time_sec
 
+def route_pair(start_coords, end_coords, start_time_min, engine="dijkstra", geometry=False):
+    """
+    what /route computes for one origin/destination, without the console
+    output or display formatting: time and cost of the engine's route and of
+    the direct snap ride, plus the map polylines when geometry is asked for
+    """
+    lat, lon = start_coords
+    lat1, lon1 = end_coords
+    walk_nodes = ChainMap({"start": nearest_walk(G_walk, lat, lon), "end": nearest_walk(G_walk, lat1, lon1)}, node_walk)
+    drive_nodes = ChainMap({"start": nearest_drive(G_drive, lat, lon), "end": nearest_drive(G_drive, lat1, lon1)}, node_drive)
+
+    graph = R.overlay()
+    graph.add_node("start")
+    graph.add_node("end")
+    add_edge_from_start_end(G_walk, graph, walk_nodes, access={
+        "start": walk_access(lat, lon),
+        "end": walk_access(lat1, lon1)
+    })
+    output = ENGINES[engine](graph, "start", "end", start_time_min)
+    snap_path, snap_cost, snap_time = snap(drive_nodes["start"], drive_nodes["end"], start_time_min)
+
+    result = {
+        "engine": engine,
+        "time_sec": output["time"] if output else None,
+        "cost": output["cost"] if output else None,
+        "modes": list(dict.fromkeys(e["mode"] for e in output["edge_path"])) if output else [],
+        "steps": len(output["edge_path"]) if output else 0,
+        "snap": {"time_sec": snap_time, "cost": snap_cost} if snap_path else None,
+    }
+    if geometry:
+        result["geometry"] = real_path(output["edge_path"], save_real, G_walk, G_drive, walk_nodes, drive_nodes) if output else {}
+        result["geometry"]["snap"] = [snap_path] if snap_path else []
+    return result
+
 def total_cost(edge_path):
     cost , f = 0 , ''
     for edge in edge_path:
@@ -354,23 +730,74 @@ def total_cost(edge_path):
 
     return cost
 
-def traffic_factor(h):
-    h = h//60
-    if 7 <= h < 9 and 13 <= h <= 15:
-        return 2
-    if 9 <= h < 16:
-        return 1.5
-    if 16 <= h < 19:
-        return 2.5
-    return 1.2
-
-G_drive , G_walk , D = create_osmGraph()
+# one memory-mapped file when `python snapshot.py` has been run since the
+# graphs last changed, the graphml and pickle files otherwise
+snapshot = load_snapshot()
+
+if snapshot is not None:
+    G_drive = snapshot.street_graph("drive")
+    G_walk = snapshot.street_graph("walk")
+    D = None
+    node_drive = snapshot.node_mapping("node_drive")
+    node_walk = snapshot.node_mapping("node_walk")
+    R = snapshot.routing_graph()
+    timetable_routes = snapshot.meta["bus_routes"]
+
+    walk_index = snapshot.spatial_index("walk_index")
+    drive_index = snapshot.spatial_index("drive_index")
+    walk_landmarks = snapshot.landmarks("walk_landmarks")
+    drive_ch = snapshot.hierarchy("drive_ch")
+    save_real = snapshot.geometry()
+else:
+    G_drive , G_walk , D = create_osmGraph()
+
+    with open('Graphes/node_drive.pkl', 'rb') as f:
+        node_drive = pickle.load(f)
+
+    with open('Graphes/node_walk.pkl', 'rb') as f:
+        node_walk = pickle.load(f)
+
+    R = RoutingGraph.from_networkx(D, node_walk, node_drive)
+    from Dgraph import bus_routes as timetable_routes
+
+    walk_index = load_or_build_index(G_walk, 'Graphes/walk_index.npz', 'Graphes/kerman_walk.graphml20')
+    drive_index = load_or_build_index(G_drive, 'Graphes/drive_index.npz', 'Graphes/kerman_drive.graphml20')
+
+    walk_landmarks = load_or_build_landmarks(G_walk, 'Graphes/walk_landmarks.npz', 'Graphes/kerman_walk.graphml20')
+    drive_ch = load_or_build_hierarchy(G_drive, 'Graphes/drive_ch.npz', 'Graphes/kerman_drive.graphml20')
+    save_real = load_geometry('Graphes/real_paths')
+
+    # serve from the same compact arrays the snapshot holds
+    G_drive = StreetGraph.from_networkx(G_drive)
+    G_walk = StreetGraph.from_networkx(G_walk)
+
+traffic = load_profile(TRAFFIC_PROFILE, traffic_factor)
+
+_ride = None
+_ride_lock = threading.Lock()
+
+def ride_engine():
+    # the snap graph is only read by the ride engine, built on the first
+    # snap() (or by start_pool); once built it is read without the lock
+    global _ride
+    if _ride is None:
+        with _ride_lock:
+            if _ride is None:
+                if snapshot is not None:
+                    G_snap = snapshot.street_graph("snap")
+                    hierarchy = snapshot.hierarchy("snap_drive_ch")
+                    weights = snapshot.array("snap_weights")
+                else:
+                    import osmnx as ox
+                    G_snap = ox.load_graphml("Graphes/snap_drive.graphml20")
+                    hierarchy = load_or_build_hierarchy(G_snap, 'Graphes/snap_drive_ch.npz', 'Graphes/snap_drive.graphml20')
+                    G_snap = StreetGraph.from_networkx(G_snap)
+                    weights = None
+                _ride = RideEngine(G_snap, hierarchy, profile=traffic, weights=weights)
+    return _ride
 
-with open('Graphes/real_paths.pkl', 'rb') as f:
-    save_real = pickle.load(f)
 
-with open('Graphes/node_drive.pkl', 'rb') as f:
-    node_drive = pickle.load(f)
+timetable = Timetable.from_routes(timetable_routes, R, BUS_END)
+connections = ConnectionScan(timetable)
 
-with open('Graphes/node_walk.pkl', 'rb') as f:
-    node_walk = pickle.load(f)
\ No newline at end of file
+stop_catalogue = StopCatalogue(timetable_routes, walk_index)
\ No newline at end of file
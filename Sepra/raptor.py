@@ -0,0 +1,196 @@
+import math
+import heapq
+from bisect import bisect_left
+
+from routing_graph import WALK
+
+# round-based transit routing (RAPTOR) over timetables generated from
+# bus_routes. round k holds the earliest arrivals using exactly k bus trips,
+# so the rounds give the arrival time / number of transfers trade-off directly.
+# times are minutes after midnight.
+
+MAX_ROUNDS = 5
+SERVICE_END = 20 * 60
+
+class Timetable:
+    def __init__(self, stops, routes, route_names, departures, transfers):
+        self.stops = stops
+        self.stop_ids = {s: i for i, s in enumerate(stops)}
+        self.routes = routes
+        self.route_names = route_names
+        # departures[r][pos] is the sorted list of trip times at that stop
+        self.departures = departures
+        self.transfers = transfers
+
+        self.stop_routes = [[] for _ in stops]
+        for r, route in enumerate(routes):
+            for pos, p in enumerate(route):
+                self.stop_routes[p].append((r, pos))
+
+    @classmethod
+    def from_routes(cls, bus_routes, R, service_end=SERVICE_END):
+        """
+        bus_routes in the Dgraph.py format (stops carry their first departure
+        minute); every line runs both ways with the same stop-to-stop gaps.
+        walking transfers are the routing graph's walk edges between stops.
+        """
+        stops = []
+        stop_ids = {}
+        for route in bus_routes.values():
+            for n, _, _, _ in route["stops"]:
+                if n not in stop_ids:
+                    stop_ids[n] = len(stops)
+                    stops.append(n)
+
+        routes, route_names, departures = [], [], []
+        for name, route in bus_routes.items():
+            interval = route["interval"]
+            names = [n for n, _, _, _ in route["stops"]]
+            starts = [start for _, _, _, start in route["stops"]]
+            first = starts[0]
+            trips = range(0, int((service_end - first) // interval) + 1)
+
+            backward = [first + starts[-1] - s for s in reversed(starts)]
+            for suffix, order, offsets in (("", names, starts), (":back", names[::-1], backward)):
+                routes.append([stop_ids[n] for n in order])
+                route_names.append(name + suffix)
+                departures.append([[t + k * interval for k in trips] for t in offsets])
+
+        indptr, head, modes, times = R.lists[:4]
+        transfers = [[] for _ in stops]
+        for u in stops:
+            i = R.ids.get(u)
+            if i is None:
+                continue
+            for k in range(indptr[i], indptr[i + 1]):
+                v = R.names[head[k]]
+                if modes[k] == WALK and v in stop_ids:
+                    transfers[stop_ids[u]].append((stop_ids[v], times[k] / 60))
+
+        return cls(stops, routes, route_names, departures, transfers)
+
+def raptor(tt, access, egress, departure, max_rounds=MAX_ROUNDS):
+    """
+    access / egress map stop names to walking seconds from the origin and to
+    the destination. returns the Pareto set of journeys, fewest trips first,
+    each arriving strictly earlier than the one before.
+    """
+    n = len(tt.stops)
+    best = [math.inf] * n
+    arrivals = [[math.inf] * n]
+    labels = [[None] * n]
+    egress = {tt.stop_ids[s]: sec / 60 for s, sec in egress.items() if s in tt.stop_ids}
+
+    marked = set()
+    for s, sec in access.items():
+        p = tt.stop_ids.get(s)
+        if p is not None and departure + sec / 60 < arrivals[0][p]:
+            arrivals[0][p] = best[p] = departure + sec / 60
+            labels[0][p] = ("access", sec / 60)
+            marked.add(p)
+    marked |= _walk(tt, arrivals[0], labels[0], best, {p: arrivals[0][p] for p in marked})
+
+    journeys = []
+    target = _target(tt, 0, arrivals, labels, egress, journeys, math.inf)
+
+    for k in range(1, max_rounds + 1):
+        if not marked:
+            break
+        prev = arrivals[-1]
+        arr = prev[:]
+        lab = [None] * n
+        arrivals.append(arr)
+        labels.append(lab)
+
+        queue = {}
+        for p in marked:
+            for r, pos in tt.stop_routes[p]:
+                if pos < queue.get(r, math.inf):
+                    queue[r] = pos
+
+        reached = {}
+        for r, first in queue.items():
+            route = tt.routes[r]
+            deps = tt.departures[r]
+            trip = board = None
+            for pos in range(first, len(route)):
+                p = route[pos]
+                if trip is not None:
+                    t = deps[pos][trip]
+                    if t < min(best[p], target):
+                        arr[p] = best[p] = reached[p] = t
+                        lab[p] = ("bus", r, trip, board, pos)
+                if prev[p] < math.inf and (trip is None or prev[p] <= deps[pos][trip]):
+                    i = bisect_left(deps[pos], prev[p])
+                    if i < len(deps[pos]) and (trip is None or i < trip):
+                        trip, board = i, pos
+
+        marked = set(reached) | _walk(tt, arr, lab, best, reached)
+        target = _target(tt, k, arrivals, labels, egress, journeys, target)
+
+    return journeys
+
+def _walk(tt, arr, lab, best, sources):
+    # the walk layer only links stops closer than 1500 m, so footpaths are
+    # not transitively closed: relax them to a fixpoint, as the decision
+    # graph search would
+    heap = [(t, p) for p, t in sources.items()]
+    heapq.heapify(heap)
+    marked = set()
+    while heap:
+        t0, p = heapq.heappop(heap)
+        if t0 > arr[p]:
+            continue
+        for q, minutes in tt.transfers[p]:
+            t = t0 + minutes
+            if t < arr[q] and t < best[q]:
+                arr[q] = best[q] = t
+                lab[q] = ("walk", p, minutes)
+                marked.add(q)
+                heapq.heappush(heap, (t, q))
+    return marked
+
+def _target(tt, k, arrivals, labels, egress, journeys, target):
+    arr = arrivals[k]
+    best_p, best_t = None, target
+    for p, minutes in egress.items():
+        if arr[p] + minutes < best_t:
+            best_p, best_t = p, arr[p] + minutes
+    if best_p is not None:
+        journeys.append({
+            "trips": k,
+            "transfers": max(k - 1, 0),
+            "arrival": best_t,
+            "legs": _legs(tt, k, labels, best_p, egress[best_p], arrivals),
+        })
+    return best_t
+
+def _legs(tt, k, labels, p, egress_minutes, arrivals):
+    legs = [{"mode": "walk", "from": tt.stops[p], "to": "end",
+             "depart": arrivals[k][p], "arrive": arrivals[k][p] + egress_minutes}]
+    while True:
+        while labels[k][p] is None:
+            k -= 1
+        label = labels[k][p]
+        if label[0] == "access":
+            legs.append({"mode": "walk", "from": "start", "to": tt.stops[p],
+                         "depart": arrivals[k][p] - label[1], "arrive": arrivals[k][p]})
+            break
+        if label[0] == "walk":
+            _, q, minutes = label
+            legs.append({"mode": "walk", "from": tt.stops[q], "to": tt.stops[p],
+                         "depart": arrivals[k][p] - minutes, "arrive": arrivals[k][p]})
+            # footpaths start from a stop reached in this same round
+            p = q
+            continue
+        _, r, trip, board, alight = label
+        route = tt.routes[r]
+        legs.append({"mode": "bus", "route": tt.route_names[r],
+                     "from": tt.stops[route[board]], "to": tt.stops[p],
+                     "stops": [tt.stops[s] for s in route[board:alight + 1]],
+                     "times": [tt.departures[r][i][trip] for i in range(board, alight + 1)],
+                     "depart": tt.departures[r][board][trip], "arrive": tt.departures[r][alight][trip]})
+        p = route[board]
+        k -= 1
+    legs.reverse()
+    return legs
@@ -0,0 +1,123 @@
+import heapq
+import math
+import numpy as np
+
+# ride-hailing (snap) engine over the snap drive graph's CSR arrays (parallel
+# edges already collapsed to the shortest); every request is a single
+# point-to-point search that returns the polyline, distance and travel time.
+# travel times come from the traffic profile's per-bucket edge weights.
+
+SNAP_SPEED = 10
+
+class RideEngine:
+    def __init__(self, G, hierarchy=None, speed=SNAP_SPEED, profile=None, weights=None):
+        # G is a snapshot.StreetGraph; its arrays are used in place, and
+        # edges are known by their CSR position. weights is the profile's
+        # edge_weights for G, shared from the snapshot when it holds them
+        self.graph = G
+        self.ids = G.ids
+        self.hierarchy = hierarchy
+        self.speed = speed
+        self.profile = profile
+        self.lengths = G.length
+        if weights is None and profile is not None:
+            weights = profile.edge_weights(G.length, G.highway, G.classes, speed)
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.graph.node_ids)
+
+    def route(self, start, end, time_min):
+        """
+        (lat, lon) polyline, metres and traffic-adjusted seconds between two
+        OSM nodes; (None, inf, inf) when end is unreachable
+        """
+        if self.profile is None or self.profile.uniform:
+            # every road slows down alike, so the shortest path is also the fastest
+            p, dist = self.path(start, end)
+            if p is None:
+                return None, math.inf, math.inf
+            if self.profile is None:
+                return self._coords(p), dist, dist / self.speed
+            edges = self._edges(p)
+            return self._coords(p), dist, float(self.weights[self.profile.row(time_min), edges].sum())
+
+        p, seconds = self.bidirectional(start, end, self.weights[self.profile.row(time_min)])
+        if p is None:
+            return None, math.inf, math.inf
+        return self._coords(p), float(self.lengths[self._edges(p)].sum()), seconds
+
+    def path(self, start, end):
+        if self.hierarchy is not None:
+            return self.hierarchy.path(start, end)
+        return self.bidirectional(start, end)
+
+    def _coords(self, p):
+        i = self.ids.positions(p)
+        return list(zip(self.graph.y[i].tolist(), self.graph.x[i].tolist()))
+
+    def _edges(self, p):
+        # CSR position of each consecutive pair's edge
+        ids = self.ids.positions(p).tolist()
+        indptr, head = self.graph.indptr, self.graph.head
+        edges = []
+        for a, b in zip(ids, ids[1:]):
+            lo, hi = indptr[a:a + 2].tolist()
+            edges.append(lo + head[lo:hi].tolist().index(b))
+        return np.array(edges, dtype=np.int64)
+
+    def _adjacent(self, u, weight, reverse=False):
+        # (neighbour, weight) of u's out- or in-edges as plain values, read
+        # from the weight row one CSR slice at a time
+        G = self.graph
+        if reverse:
+            a, b = G.rindptr[u:u + 2].tolist()
+            return zip(G.rhead[a:b].tolist(), weight[G.redge[a:b]].tolist())
+        a, b = G.indptr[u:u + 2].tolist()
+        return zip(G.head[a:b].tolist(), weight[a:b].tolist())
+
+    def bidirectional(self, start, end, weight=None):
+        # dijkstra from both ends, stopped once the two frontiers together
+        # can no longer beat the best meeting point; weight is per edge id
+        # (a row of self.weights) and defaults to length
+        if weight is None:
+            weight = self.lengths
+        s, t = self.ids.get(start), self.ids.get(end)
+        if s is None or t is None:
+            return None, math.inf
+        dist = ({s: 0.0}, {t: 0.0})
+        parent = ({s: None}, {t: None})
+        queues = ([(0.0, s)], [(0.0, t)])
+        done = (set(), set())
+        best, meet = (0.0, s) if s == t else (math.inf, None)
+
+        while queues[0] and queues[1] and queues[0][0][0] + queues[1][0][0] < best:
+            side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+            d, u = heapq.heappop(queues[side])
+            if u in done[side]:
+                continue
+            done[side].add(u)
+            mine, other = dist[side], dist[1 - side]
+            for v, w in self._adjacent(u, weight, side == 1):
+                nd = d + w
+                if nd < mine.get(v, math.inf):
+                    mine[v] = nd
+                    parent[side][v] = u
+                    heapq.heappush(queues[side], (nd, v))
+                if v in other and mine[v] + other[v] < best:
+                    best, meet = mine[v] + other[v], v
+
+        if meet is None:
+            return None, math.inf
+
+        nodes = []
+        u = meet
+        while u is not None:
+            nodes.append(u)
+            u = parent[0][u]
+        nodes.reverse()
+        u = parent[1][meet]
+        while u is not None:
+            nodes.append(u)
+            u = parent[1][u]
+        return self.graph.node_ids[nodes].tolist(), float(best)
@@ -0,0 +1,81 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# bounded LRU cache of complete /route results with a time-to-live. entries
+# are dropped wholesale when any of the graph artifacts on disk changes; the
+# graphs themselves are only reloaded when the process restarts.
+
+class RouteCache:
+    def __init__(self, maxsize=512, ttl=15 * 60, artifacts=()):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.artifacts = list(artifacts)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stamp = self.artifact_stamp()
+
+    def artifact_stamp(self):
+        stamp = []
+        for path in self.artifacts:
+            try:
+                st = os.stat(path)
+                stamp.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append((path, None, None))
+        return tuple(stamp)
+
+    def _check_artifacts(self):
+        stamp = self.artifact_stamp()
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.entries.clear()
+            self.invalidations += 1
+
+    def get(self, key):
+        # returns a copy, callers are free to edit it
+        with self.lock:
+            self._check_artifacts()
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,130 @@
+import numpy as np
+
+# array-backed (CSR) copy of the decision graph for routing. node names are
+# interned to 0..n-1, edges of node i sit at indptr[i]:indptr[i + 1] in the
+# parallel edge arrays, in the same order networkx iterates them.
+
+MODES = ["walk", "bus", "taxi"]
+MODE_ID = {m: i for i, m in enumerate(MODES)}
+WALK, BUS, TAXI = 0, 1, 2
+
+class RoutingGraph:
+    def __init__(self, names, indptr, head, mode, distance, time, cost, interval, start, same_line, osm_walk, osm_drive):
+        self.names = list(names)
+        self.ids = {n: i for i, n in enumerate(self.names)}
+        self.indptr = indptr
+        self.head = head
+        self.mode = mode
+        self.distance = distance
+        self.time = time
+        self.cost = cost
+        self.interval = interval
+        self.start = start
+        self.same_line = same_line
+        self.osm_walk = osm_walk
+        self.osm_drive = osm_drive
+
+        # the search loop is plain python, which reads arrays element by element
+        # slowly; memoryviews read about as fast as lists and, unlike .tolist(),
+        # keep reading the (possibly shared) arrays instead of a private copy
+        self.lists = tuple(memoryview(np.ascontiguousarray(a)) for a in (indptr, head, mode, time, cost, interval, start, same_line))
+
+    @classmethod
+    def from_networkx(cls, D, node_walk=None, node_drive=None):
+        names = [str(n) for n in D.nodes]
+        ids = {n: i for i, n in enumerate(names)}
+        indptr = [0]
+        cols = {k: [] for k in ("head", "mode", "distance", "time", "cost", "interval", "start", "same_line")}
+
+        for u in D.nodes:
+            for v, data in D[u].items():
+                mode = MODE_ID.get(data.get("mode", "walk"), WALK)
+                u_name, v_name = str(u), str(v)
+                cols["head"].append(ids[v_name])
+                cols["mode"].append(mode)
+                cols["distance"].append(data.get("distance", 0))
+                cols["time"].append(data.get("time", 0))
+                cols["cost"].append(data.get("cost") or 0)
+                cols["interval"].append(data.get("interval", 0))
+                cols["start"].append(data.get("start", 480))
+                cols["same_line"].append(mode == BUS and u_name[4:5] == v_name[4:5])
+            indptr.append(len(cols["head"]))
+
+        return cls(
+            names,
+            np.array(indptr, dtype=np.int64),
+            np.array(cols["head"], dtype=np.int64),
+            np.array(cols["mode"], dtype=np.int8),
+            np.array(cols["distance"], dtype=np.float64),
+            np.array(cols["time"], dtype=np.float64),
+            np.array(cols["cost"], dtype=np.int64),
+            np.array(cols["interval"], dtype=np.int64),
+            np.array(cols["start"], dtype=np.int64),
+            np.array(cols["same_line"], dtype=bool),
+            osm_array(names, node_walk),
+            osm_array(names, node_drive),
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def number_of_edges(self):
+        return len(self.head)
+
+    def overlay(self):
+        return RoutingView(self)
+
+def osm_array(names, node_osm):
+    # decision-graph names are strings, the pickled mappings mix str and int keys
+    out = np.full(len(names), -1, dtype=np.int64)
+    if node_osm is None:
+        return out
+    for i, n in enumerate(names):
+        osm = node_osm.get(n)
+        if osm is None and n.isdigit():
+            osm = node_osm.get(int(n))
+        if osm is not None:
+            out[i] = osm
+    return out
+
+class RoutingView:
+    """
+    a routing graph plus extra nodes and edges (the request's start/end),
+    exposing the small part of the networkx API add_edge_from_start_end uses
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.names = base.names
+        self.extra_names = []
+        self.extra_ids = {}
+        self.extra = {}
+
+    def id(self, name):
+        i = self.base.ids.get(name)
+        if i is None:
+            i = self.extra_ids[name]
+        return i
+
+    def name(self, i):
+        n = len(self.base.names)
+        return self.names[i] if i < n else self.extra_names[i - n]
+
+    def __len__(self):
+        return len(self.base.names) + len(self.extra_names)
+
+    @property
+    def nodes(self):
+        return self.base.names + self.extra_names
+
+    def add_node(self, name):
+        if name not in self.base.ids and name not in self.extra_ids:
+            self.extra_ids[name] = len(self)
+            self.extra_names.append(name)
+
+    def add_edge(self, u, v, mode="walk", distance=0, cost=0, time=0, interval=0, start=480):
+        self.add_node(u)
+        self.add_node(v)
+        m = MODE_ID.get(mode, WALK)
+        self.extra.setdefault(self.id(u), []).append(
+            (self.id(v), m, time, cost or 0, interval, start, False))
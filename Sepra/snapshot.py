@@ -0,0 +1,340 @@
+import argparse
+import json
+import math
+import os
+import pickle
+import struct
+import time
+from datetime import datetime
+import numpy as np
+
+from contraction import Hierarchy, load_or_build_hierarchy, ARRAYS as HIERARCHY_ARRAYS
+from csr import IdIndex, Neighbors
+from geometry import GeometryStore
+from landmarks import Landmarks, load_or_build_landmarks, ARRAYS as LANDMARK_ARRAYS
+from routing_graph import RoutingGraph
+from ride import SNAP_SPEED
+from spatial import SpatialIndex, load_or_build_index, ARRAYS as INDEX_ARRAYS
+from traffic import road_class, load_profile, traffic_factor, TRAFFIC_PROFILE
+
+# every read-only array the server uses, in one file that loads by
+# memory-mapping: an 8-byte magic, a version, a small JSON header and the
+# arrays themselves, each aligned so it can be viewed in place. worker
+# processes map the same file, so they share one physical copy through the
+# page cache. street graphs keep node coordinates and CSR adjacency (parallel
+# edges collapsed to the shortest); the decision graph keeps the
+# RoutingGraph arrays; spatial indexes, landmarks, hierarchies and leg
+# geometry keep the arrays they are saved with; the ride engine's per-bucket
+# edge travel times (snap_weights) come from the traffic profile.
+
+MAGIC = b"SEPRASNP"
+VERSION = 4
+ALIGN = 64
+
+SNAPSHOT = "Graphes/snapshot.bin"
+STREET_GRAPHS = {
+    "walk": "Graphes/kerman_walk.graphml20",
+    "drive": "Graphes/kerman_drive.graphml20",
+    "snap": "Graphes/snap_drive.graphml20",
+}
+DECISION_GRAPH = "Graphes/Dgraph.graphml"
+NODE_WALK = "Graphes/node_walk.pkl"
+NODE_DRIVE = "Graphes/node_drive.pkl"
+GEOMETRY = "Graphes/real_paths"
+
+# artifacts built from each street graph (when missing or stale) and packed
+# under their file name, e.g. walk_index
+DERIVED = {
+    "walk": [(load_or_build_index, "Graphes/walk_index.npz", INDEX_ARRAYS),
+             (load_or_build_landmarks, "Graphes/walk_landmarks.npz", LANDMARK_ARRAYS)],
+    "drive": [(load_or_build_index, "Graphes/drive_index.npz", INDEX_ARRAYS),
+              (load_or_build_hierarchy, "Graphes/drive_ch.npz", HIERARCHY_ARRAYS)],
+    "snap": [(load_or_build_hierarchy, "Graphes/snap_drive_ch.npz", HIERARCHY_ARRAYS)],
+}
+
+# Dgraph.py holds the bus timetable, which the snapshot carries too, and
+# traffic.py the city-wide factors snap_weights fall back on
+SOURCES = list(STREET_GRAPHS.values()) + [
+    DECISION_GRAPH, NODE_WALK, NODE_DRIVE, "Dgraph.py", TRAFFIC_PROFILE, "traffic.py",
+    GEOMETRY + "_coords.npy", GEOMETRY + "_offsets.npy", GEOMETRY + "_index.pkl",
+]
+
+ROUTING_ARRAYS = ["indptr", "head", "mode", "distance", "time", "cost", "interval", "start", "same_line", "osm_walk", "osm_drive"]
+STREET_ARRAYS = ["node_ids", "x", "y", "indptr", "head", "length", "highway", "rindptr", "rhead", "redge", "rlength"]
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic, version, size = struct.unpack("<8sII", f.read(16))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a graph snapshot")
+            if version != VERSION:
+                raise ValueError(f"{path} has snapshot version {version}, expected {VERSION}")
+            self.header = json.loads(f.read(size).decode("utf-8"))
+        self.path = path
+        self.meta = self.header["meta"]
+        # one read-only mapping; arrays are views into it and pages are read on first touch
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def __contains__(self, name):
+        return name in self.header["arrays"]
+
+    def array(self, name):
+        dtype, shape, offset = self.header["arrays"][name]
+        count = math.prod(shape)
+        return np.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def arrays(self, prefix, names):
+        return {k: self.array(f"{prefix}_{k}") for k in names}
+
+    def street_graph(self, name):
+        return StreetGraph(self.arrays(name, STREET_ARRAYS), self.meta[name + "_classes"])
+
+    def routing_graph(self):
+        return RoutingGraph(self.meta["decision_names"], *self.arrays("decision", ROUTING_ARRAYS).values())
+
+    def node_mapping(self, name):
+        # pairs keep the pickled mappings' mix of str and int keys
+        return {k: v for k, v in self.meta[name]}
+
+    def spatial_index(self, name):
+        return SpatialIndex(self.arrays(name, INDEX_ARRAYS))
+
+    def landmarks(self, name):
+        return Landmarks(self.arrays(name, LANDMARK_ARRAYS))
+
+    def hierarchy(self, name):
+        return Hierarchy(self.arrays(name, HIERARCHY_ARRAYS))
+
+    def geometry(self):
+        index = {(u, v): i for i, (u, v) in enumerate(self.meta["geometry_edges"])}
+        return GeometryStore(self.array("geometry_coords"), self.array("geometry_offsets"), index)
+
+class NodeView:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __len__(self):
+        return len(self.graph.node_ids)
+
+    def __iter__(self):
+        return iter(self.graph.node_ids.tolist())
+
+    def __contains__(self, n):
+        return n in self.graph.ids
+
+    def __getitem__(self, n):
+        i = self.graph.ids[n]
+        return {"x": float(self.graph.x[i]), "y": float(self.graph.y[i])}
+
+class StreetGraph:
+    """
+    read-only street graph over CSR arrays (nodes sorted by OSM id), with the
+    networkx calls the serving code makes: nodes[n]["x"/"y"] and the counts
+    """
+
+    def __init__(self, arrays, classes):
+        self.__dict__.update(arrays)
+        self.classes = classes
+        self.ids = IdIndex(self.node_ids)
+
+    @classmethod
+    def from_networkx(cls, G):
+        arrays, classes = street_arrays(G)
+        return cls(arrays, classes)
+
+    @property
+    def nodes(self):
+        return NodeView(self)
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.head)
+
+    def coords(self, nodes):
+        # (lat array, lon array) for a list of nodes
+        i = self.ids.positions(np.asarray(nodes, dtype=np.int64))
+        return self.y[i], self.x[i]
+
+    def adjacency(self, reverse=False):
+        # node -> [(neighbour, length)], what map.flat_adjacency builds from networkx
+        if reverse:
+            return Neighbors(self.rindptr, self.rhead, self.rlength, self.node_ids, self.ids)
+        return Neighbors(self.indptr, self.head, self.length, self.node_ids, self.ids)
+
+    def bounded_lengths(self, sources, cutoff, reverse=False):
+        """
+        same as map.bounded_lengths, as a label-correcting search that
+        relaxes the whole frontier per step with numpy instead of a heap
+        """
+        indptr, head, length = (self.rindptr, self.rhead, self.rlength) if reverse else (self.indptr, self.head, self.length)
+        dist = np.full(len(self.node_ids), np.inf)
+        for n, off in sources:
+            i = self.ids[n]
+            dist[i] = min(dist[i], off)
+        frontier = np.flatnonzero(np.isfinite(dist))
+        while len(frontier):
+            lo, hi = indptr[frontier], indptr[frontier + 1]
+            counts = hi - lo
+            total = int(counts.sum())
+            if not total:
+                break
+            # positions of every edge leaving the frontier
+            edges = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+            nd = np.repeat(dist[frontier], counts) + length[edges]
+            to = head[edges]
+            keep = (nd < cutoff) & (nd < dist[to])
+            to, nd = to[keep], nd[keep]
+            np.minimum.at(dist, to, nd)
+            frontier = np.unique(to[nd == dist[to]])
+        reached = np.flatnonzero(dist < np.inf)
+        return dict(zip(self.node_ids[reached].tolist(), dist[reached].tolist()))
+
+def street_arrays(G):
+    """
+    node coordinates plus forward and reverse CSR adjacency, nodes sorted by
+    id; of parallel edges the first shortest one is kept, with its road class
+    """
+    node_ids = np.sort(np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes()))
+    ids = {int(n): i for i, n in enumerate(node_ids)}
+    classes = [""]
+    class_ids = {"": 0}
+    tails, heads, lengths, highways = [], [], [], []
+    for u in node_ids.tolist():
+        for v, edges in G.succ[u].items():
+            best = None
+            for data in edges.values():
+                w = data.get("length", 1)
+                if best is None or w < best[0]:
+                    best = (w, road_class(data.get("highway")))
+            if best[1] not in class_ids:
+                class_ids[best[1]] = len(classes)
+                classes.append(best[1])
+            tails.append(ids[u])
+            heads.append(ids[v])
+            lengths.append(best[0])
+            highways.append(class_ids[best[1]])
+
+    n = len(node_ids)
+    tails = np.array(tails, dtype=np.int64)
+    heads = np.array(heads, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.float64)
+    # reverse CSR: the same edges grouped by head, with their forward position
+    redge = np.argsort(heads, kind="stable")
+    return {
+        "node_ids": node_ids,
+        "x": np.array([G.nodes[n]["x"] for n in node_ids.tolist()], dtype=np.float64),
+        "y": np.array([G.nodes[n]["y"] for n in node_ids.tolist()], dtype=np.float64),
+        "indptr": np.searchsorted(tails, np.arange(n + 1)).astype(np.int64),
+        "head": heads,
+        "length": lengths,
+        "highway": np.array(highways, dtype=np.int16),
+        "rindptr": np.searchsorted(heads[redge], np.arange(n + 1)).astype(np.int64),
+        "rhead": tails[redge],
+        "redge": redge.astype(np.int64),
+        "rlength": lengths[redge],
+    }, classes
+
+def write_snapshot(path, arrays, meta):
+    header = {"version": VERSION, "created": datetime.now().isoformat(), "meta": meta, "arrays": {}}
+    # offsets depend on the header size, which depends on the offsets; pad
+    # the header to a fixed block so one pass settles both
+    names = list(arrays)
+    for block in (1 << 16, 1 << 20, 1 << 24, 1 << 28):
+        offset = 16 + block
+        for k in names:
+            a = np.asarray(arrays[k], order="C")
+            header["arrays"][k] = [a.dtype.str, list(a.shape), offset]
+            offset += -(-a.nbytes // ALIGN) * ALIGN
+        encoded = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if len(encoded) <= block:
+            break
+    else:
+        raise ValueError("snapshot header too large")
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<8sII", MAGIC, VERSION, block))
+        f.write(encoded.ljust(block, b" "))
+        for k in names:
+            a = np.asarray(arrays[k], order="C")
+            f.seek(header["arrays"][k][2])
+            f.write(a.tobytes())
+        f.truncate(offset)
+    os.replace(tmp, path)
+
+def _pairs(node_osm):
+    # osmnx hands out numpy integers, which JSON does not take
+    return [[k if isinstance(k, str) else int(k), int(v)] for k, v in node_osm.items()]
+
+def build_snapshot(path=SNAPSHOT):
+    import osmnx as ox
+    import networkx as nx
+    from Dgraph import bus_routes
+    from geometry import load_geometry
+
+    arrays, meta = {}, {}
+    for name, source in STREET_GRAPHS.items():
+        G = ox.load_graphml(source)
+        for load_or_build, artifact, names in DERIVED[name]:
+            built = load_or_build(G, artifact, source)
+            prefix = os.path.basename(artifact).rsplit(".", 1)[0]
+            arrays.update({f"{prefix}_{k}": np.asarray(getattr(built, k)) for k in names})
+        street, classes = street_arrays(G)
+        arrays.update({f"{name}_{k}": a for k, a in street.items()})
+        meta[name + "_classes"] = classes
+
+    profile = load_profile(TRAFFIC_PROFILE, traffic_factor)
+    arrays["snap_weights"] = profile.edge_weights(arrays["snap_length"], arrays["snap_highway"], meta["snap_classes"], SNAP_SPEED)
+
+    with open(NODE_WALK, "rb") as f:
+        node_walk = pickle.load(f)
+    with open(NODE_DRIVE, "rb") as f:
+        node_drive = pickle.load(f)
+    R = RoutingGraph.from_networkx(nx.read_graphml(DECISION_GRAPH), node_walk, node_drive)
+    for k in ROUTING_ARRAYS:
+        arrays["decision_" + k] = getattr(R, k)
+    meta["decision_names"] = R.names
+    meta["node_walk"] = _pairs(node_walk)
+    meta["node_drive"] = _pairs(node_drive)
+    meta["bus_routes"] = bus_routes
+
+    store = load_geometry(GEOMETRY)
+    arrays["geometry_coords"] = np.asarray(store.coords)
+    arrays["geometry_offsets"] = np.asarray(store.offsets)
+    meta["geometry_edges"] = [list(edge) for edge, _ in sorted(store.index.items(), key=lambda item: item[1])]
+
+    write_snapshot(path, arrays, meta)
+
+def is_current(path=SNAPSHOT, sources=SOURCES):
+    if not os.path.exists(path):
+        return False
+    built = os.path.getmtime(path)
+    return all(os.path.getmtime(s) <= built for s in sources if os.path.exists(s))
+
+def load_snapshot(path=SNAPSHOT, sources=SOURCES):
+    # None when there is no usable snapshot; the caller reads the graphml files
+    if not is_current(path, sources):
+        return None
+    try:
+        return Snapshot(path)
+    except ValueError as e:
+        print(f"{e}; reading the graph files instead")
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="pack the served graphs into one memory-mapped snapshot")
+    parser.add_argument("--force", action="store_true", help="rebuild even when the snapshot is current")
+    args = parser.parse_args()
+
+    if not args.force and load_snapshot() is not None:
+        print(f"{SNAPSHOT} is up to date")
+        return
+    start = time.perf_counter()
+    build_snapshot()
+    print(f"{SNAPSHOT}: {os.path.getsize(SNAPSHOT) / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import math
+import os
+import numpy as np
+
+from csr import sort_ids
+
+# uniform-grid spatial index over a street graph, in local metres
+# (equirectangular around the graph centre, well under 0.1% error at city scale).
+# nodes and edge segments are bucketed per cell in CSR form so the index
+# saves to a single .npz and answers a query by scanning a few rings of cells.
+
+EARTH_RADIUS = 6371009
+CELL_SIZE = 150
+
+class SpatialIndex:
+    def __init__(self, arrays):
+        self.__dict__.update(arrays)
+        # for IdIndex over node_ids; sorted once at build and saved with the index
+        if "id_order" not in arrays:
+            self.id_order, self.id_sorted = sort_ids(self.node_ids)
+        self.x0 = float(self.x0)
+        self.y0 = float(self.y0)
+        self.lat0 = float(self.origin[0])
+        self.lon0 = float(self.origin[1])
+        self.kx = EARTH_RADIUS * math.radians(1) * math.cos(math.radians(self.lat0))
+        self.ky = EARTH_RADIUS * math.radians(1)
+        self.cell = float(self.origin[2])
+        self.ncols = int(self.shape[0])
+        self.nrows = int(self.shape[1])
+
+    def project(self, lat, lon):
+        return (np.asarray(lon) - self.lon0) * self.kx, (np.asarray(lat) - self.lat0) * self.ky
+
+    def unproject(self, x, y):
+        return self.lat0 + y / self.ky, self.lon0 + x / self.kx
+
+    def _ring(self, starts, items, cx, cy, r):
+        # item positions in the cells at Chebyshev distance r from (cx, cy)
+        found = []
+        for j in range(cy - r, cy + r + 1):
+            if not 0 <= j < self.nrows:
+                continue
+            step = 1 if j in (cy - r, cy + r) else 2 * r
+            for i in range(cx - r, cx + r + 1, max(step, 1)):
+                if 0 <= i < self.ncols:
+                    c = j * self.ncols + i
+                    found.append(items[starts[c]:starts[c + 1]])
+        return np.concatenate(found) if found else items[:0]
+
+    def _cell_of(self, x, y):
+        cx = min(max(int((x - self.x0) // self.cell), 0), self.ncols - 1)
+        cy = min(max(int((y - self.y0) // self.cell), 0), self.nrows - 1)
+        return cx, cy
+
+    def _search(self, x, y, starts, items, distance):
+        cx, cy = self._cell_of(x, y)
+        best, best_d = None, math.inf
+        for r in range(max(self.ncols, self.nrows) + 1):
+            cand = self._ring(starts, items, cx, cy, r)
+            if len(cand):
+                d = distance(cand, x, y)
+                k = int(np.argmin(d))
+                if d[k] < best_d:
+                    best, best_d = cand[k], float(d[k])
+            # nothing in ring r + 1 or beyond can be closer than r cells
+            if best is not None and best_d <= r * self.cell:
+                break
+        return best, best_d
+
+    def nearest(self, lat, lon):
+        x, y = self.project(lat, lon)
+        i, _ = self._search(float(x), float(y), self.node_starts, self.node_items, self._node_distance)
+        return int(self.node_ids[i])
+
+    def nearest_many(self, lats, lons):
+        """
+        nearest() for many points at once: the same ring search, one ring
+        for every unfinished point per step, with the same tie-breaking
+        """
+        x, y = self.project(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        cx = np.clip(((x - self.x0) // self.cell).astype(np.int64), 0, self.ncols - 1)
+        cy = np.clip(((y - self.y0) // self.cell).astype(np.int64), 0, self.nrows - 1)
+        best = np.full(len(x), -1, dtype=np.int64)
+        best_d = np.full(len(x), np.inf)
+        active = np.arange(len(x))
+        for r in range(max(self.ncols, self.nrows) + 1):
+            if not len(active):
+                break
+            dj, di = _ring_offsets(r)
+            owner = np.repeat(active, len(dj))
+            j = (cy[active][:, None] + dj).ravel()
+            i = (cx[active][:, None] + di).ravel()
+            inside = (j >= 0) & (j < self.nrows) & (i >= 0) & (i < self.ncols)
+            owner, c = owner[inside], (j * self.ncols + i)[inside]
+
+            # every node in those cells, grouped by point in ring order
+            lo, hi = self.node_starts[c], self.node_starts[c + 1]
+            counts = hi - lo
+            total = int(counts.sum())
+            if total:
+                cand = self.node_items[np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)]
+                owner = np.repeat(owner, counts)
+                d = np.hypot(self.node_x[cand] - x[owner], self.node_y[cand] - y[owner])
+                # first smallest distance per point, as argmin picks it
+                order = np.lexsort((d, owner))
+                first = order[np.r_[True, owner[order][1:] != owner[order][:-1]]]
+                p = owner[first]
+                closer = d[first] < best_d[p]
+                best[p[closer]] = cand[first][closer]
+                best_d[p[closer]] = d[first][closer]
+            # nothing in ring r + 1 or beyond can be closer than r cells
+            active = active[(best[active] < 0) | (best_d[active] > r * self.cell)]
+        return self.node_ids[best].tolist()
+
+    def _node_distance(self, cand, x, y):
+        return np.hypot(self.node_x[cand] - x, self.node_y[cand] - y)
+
+    def _segment_projection(self, cand, x, y):
+        ax, ay, bx, by = self.seg_ax[cand], self.seg_ay[cand], self.seg_bx[cand], self.seg_by[cand]
+        dx, dy = bx - ax, by - ay
+        ll = dx * dx + dy * dy
+        t = np.clip(((x - ax) * dx + (y - ay) * dy) / np.where(ll > 0, ll, 1), 0, 1)
+        return t, ax + t * dx, ay + t * dy
+
+    def _segment_distance(self, cand, x, y):
+        _, px, py = self._segment_projection(cand, x, y)
+        return np.hypot(px - x, py - y)
+
+    def nearest_edge(self, lat, lon):
+        """
+        snaps a point onto the closest edge and interpolates along it:
+        returns u, v, key, the snapped (lat, lon), the distance from the
+        point to the edge and the along-edge distances to u and to v
+        """
+        x, y = self.project(lat, lon)
+        x, y = float(x), float(y)
+        s, d = self._search(x, y, self.seg_starts, self.seg_items, self._segment_distance)
+        t, px, py = self._segment_projection(np.array([s]), x, y)
+        along = float(self.seg_offset[s] + t[0] * np.hypot(self.seg_bx[s] - self.seg_ax[s], self.seg_by[s] - self.seg_ay[s]))
+        # scale the straight-line offset onto the edge's stored length
+        geo = float(self.edge_geo[self.seg_edge[s]])
+        length = float(self.edge_length[self.seg_edge[s]])
+        to_u = along * length / geo if geo > 0 else 0.0
+        e = self.seg_edge[s]
+        snapped = self.unproject(float(px[0]), float(py[0]))
+        return {
+            "u": int(self.edge_u[e]),
+            "v": int(self.edge_v[e]),
+            "key": int(self.edge_key[e]),
+            "point": (float(snapped[0]), float(snapped[1])),
+            "distance": d,
+            "to_u": to_u,
+            "to_v": max(length - to_u, 0.0),
+        }
+
+    def save(self, path):
+        # written under a per-process name and renamed, so workers starting
+        # together never load each other's half-written index
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **{k: getattr(self, k) for k in ARRAYS})
+        os.replace(tmp, path)
+
+def _ring_offsets(r):
+    # (row, column) offsets of the cells at Chebyshev distance r, in the order _ring visits them
+    dj, di = [], []
+    for j in range(-r, r + 1):
+        cols = range(-r, r + 1) if j in (-r, r) else (-r, r)
+        dj.extend([j] * len(cols))
+        di.extend(cols)
+    return np.array(dj, dtype=np.int64), np.array(di, dtype=np.int64)
+
+def _bucket(cx, cy, ncols, ncells):
+    cells = cy * ncols + cx
+    order = np.argsort(cells, kind="stable")
+    starts = np.searchsorted(cells[order], np.arange(ncells + 1))
+    return starts.astype(np.int64), order.astype(np.int64)
+
+def build_index(G, cell=CELL_SIZE):
+    ids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+    lat = np.array([G.nodes[n]["y"] for n in G.nodes])
+    lon = np.array([G.nodes[n]["x"] for n in G.nodes])
+    lat0, lon0 = float(lat.mean()), float(lon.mean())
+    kx = EARTH_RADIUS * math.radians(1) * math.cos(math.radians(lat0))
+    ky = EARTH_RADIUS * math.radians(1)
+    node_x, node_y = (lon - lon0) * kx, (lat - lat0) * ky
+
+    # one straight segment per piece of each edge's geometry
+    edge_u, edge_v, edge_key, edge_length, edge_geo = [], [], [], [], []
+    seg = []
+    for e, (u, v, k, data) in enumerate(G.edges(keys=True, data=True)):
+        geometry = data.get("geometry")
+        if geometry is not None:
+            pts = [((px - lon0) * kx, (py - lat0) * ky) for px, py in geometry.coords]
+        else:
+            pts = [((G.nodes[u]["x"] - lon0) * kx, (G.nodes[u]["y"] - lat0) * ky),
+                   ((G.nodes[v]["x"] - lon0) * kx, (G.nodes[v]["y"] - lat0) * ky)]
+        offset = 0.0
+        for (ax, ay), (bx, by) in zip(pts, pts[1:]):
+            seg.append((ax, ay, bx, by, offset, e))
+            offset += math.hypot(bx - ax, by - ay)
+        edge_u.append(u)
+        edge_v.append(v)
+        edge_key.append(k)
+        edge_length.append(data.get("length", offset))
+        edge_geo.append(offset)
+    seg = np.array(seg, dtype=np.float64).reshape(-1, 6)
+
+    x0 = float(node_x.min()) - cell
+    y0 = float(node_y.min()) - cell
+    ncols = int((node_x.max() - x0) // cell) + 2
+    nrows = int((node_y.max() - y0) // cell) + 2
+    ncells = ncols * nrows
+
+    def cell_of(v, v0, n):
+        return np.clip(((v - v0) // cell).astype(np.int64), 0, n - 1)
+
+    node_starts, node_items = _bucket(cell_of(node_x, x0, ncols), cell_of(node_y, y0, nrows), ncols, ncells)
+
+    # a segment goes into every cell of its bounding box
+    sx0 = cell_of(np.minimum(seg[:, 0], seg[:, 2]), x0, ncols)
+    sx1 = cell_of(np.maximum(seg[:, 0], seg[:, 2]), x0, ncols)
+    sy0 = cell_of(np.minimum(seg[:, 1], seg[:, 3]), y0, nrows)
+    sy1 = cell_of(np.maximum(seg[:, 1], seg[:, 3]), y0, nrows)
+    owner, cxs, cys = [], [], []
+    for s in range(len(seg)):
+        for j in range(sy0[s], sy1[s] + 1):
+            for i in range(sx0[s], sx1[s] + 1):
+                owner.append(s)
+                cxs.append(i)
+                cys.append(j)
+    seg_starts, order = _bucket(np.array(cxs, dtype=np.int64), np.array(cys, dtype=np.int64), ncols, ncells)
+    seg_items = np.array(owner, dtype=np.int64)[order]
+
+    return SpatialIndex({
+        "origin": np.array([lat0, lon0, cell]),
+        "shape": np.array([ncols, nrows]),
+        "x0": x0,
+        "y0": y0,
+        "node_ids": ids,
+        "node_x": node_x,
+        "node_y": node_y,
+        "node_starts": node_starts,
+        "node_items": node_items,
+        "seg_ax": seg[:, 0],
+        "seg_ay": seg[:, 1],
+        "seg_bx": seg[:, 2],
+        "seg_by": seg[:, 3],
+        "seg_offset": seg[:, 4],
+        "seg_edge": seg[:, 5].astype(np.int64),
+        "seg_starts": seg_starts,
+        "seg_items": seg_items,
+        "edge_u": np.array(edge_u, dtype=np.int64),
+        "edge_v": np.array(edge_v, dtype=np.int64),
+        "edge_key": np.array(edge_key, dtype=np.int64),
+        "edge_length": np.array(edge_length, dtype=np.float64),
+        "edge_geo": np.array(edge_geo, dtype=np.float64),
+    })
+
+ARRAYS = [
+    "origin", "shape", "x0", "y0",
+    "node_ids", "node_x", "node_y", "node_starts", "node_items",
+    "seg_ax", "seg_ay", "seg_bx", "seg_by", "seg_offset", "seg_edge", "seg_starts", "seg_items",
+    "edge_u", "edge_v", "edge_key", "edge_length", "edge_geo",
+    "id_order", "id_sorted",
+]
+
+def load_index(path):
+    with np.load(path) as data:
+        # files saved without the sorted ids get them computed on load
+        return SpatialIndex({k: data[k] for k in ARRAYS if k in data})
+
+def load_or_build_index(G, path, source):
+    # reuse the saved index unless the graph file is newer
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source):
+        return load_index(path)
+    index = build_index(G)
+    index.save(path)
+    return index
@@ -0,0 +1,78 @@
+import math
+import numpy as np
+from csr import IdIndex
+
+# every bus stop of every line, snapped to the walk graph once: parallel
+# arrays (name, line, lat/lon, local x/y, walk node) plus a uniform grid over
+# the projected positions, so a "stops near me" query reads one bounded walk
+# search instead of snapping and searching per stop.
+
+CELL_SIZE = 500
+
+class StopCatalogue:
+    def __init__(self, routes, index, cell=CELL_SIZE):
+        # routes: {line: {"stops": [(name, lat, lon, ...), ...]}}, index: the walk SpatialIndex
+        rows = [(stop[0], line, float(stop[1]), float(stop[2]))
+                for line, route in routes.items() for stop in route["stops"]]
+        self.index = index
+        self.names = np.array([r[0] for r in rows], dtype=object)
+        self.lines = np.array([r[1] for r in rows], dtype=object)
+        self.lat = np.array([r[2] for r in rows], dtype=np.float64)
+        self.lon = np.array([r[3] for r in rows], dtype=np.float64)
+        self.x, self.y = index.project(self.lat, self.lon)
+        self.walk_node = np.array([index.nearest(lat, lon) for lat, lon in zip(self.lat, self.lon)], dtype=np.int64)
+
+        # how far a stop sits from its walk node; widens the straight-line
+        # prefilter so it never drops a stop the walk search can reach
+        self.node_at = IdIndex(index.node_ids, index.id_order, index.id_sorted)
+        at = self.node_at.positions(self.walk_node)
+        self.slack = float(np.hypot(index.node_x[at] - self.x, index.node_y[at] - self.y).max()) if len(at) else 0.0
+
+        self.cell = cell
+        self.x0 = float(self.x.min()) if len(rows) else 0.0
+        self.y0 = float(self.y.min()) if len(rows) else 0.0
+        cx, cy = self._cells(self.x, self.y)
+        self.ncols = int(cx.max()) + 1 if len(rows) else 1
+        self.nrows = int(cy.max()) + 1 if len(rows) else 1
+        cells = cy * self.ncols + cx
+        self.items = np.argsort(cells, kind="stable")
+        self.starts = np.searchsorted(cells[self.items], np.arange(self.ncols * self.nrows + 1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def _cells(self, x, y):
+        return ((np.asarray(x) - self.x0) // self.cell).astype(np.int64), ((np.asarray(y) - self.y0) // self.cell).astype(np.int64)
+
+    def within(self, lat, lon, radius):
+        # stop positions no further than radius in a straight line
+        x, y = self.index.project(lat, lon)
+        x, y = float(x), float(y)
+        i0, j0 = self._cells(x - radius, y - radius)
+        i1, j1 = self._cells(x + radius, y + radius)
+        found = []
+        for j in range(max(int(j0), 0), min(int(j1), self.nrows - 1) + 1):
+            a = j * self.ncols + max(int(i0), 0)
+            b = j * self.ncols + min(int(i1), self.ncols - 1)
+            if a <= b:
+                found.append(self.items[self.starts[a]:self.starts[b + 1]])
+        cand = np.concatenate(found) if found else self.items[:0]
+        return cand[np.hypot(self.x[cand] - x, self.y[cand] - y) <= radius]
+
+    def nearest(self, lat, lon, source, lengths, radius, k):
+        """
+        the k stops closest on foot, given the walk distances of one bounded
+        search from the query's walk node source (node -> metres, all below
+        radius); returns (stop positions, metres) sorted by distance and how
+        many stops are within radius in all
+        """
+        x, y = self.index.project(lat, lon)
+        at = self.node_at[int(source)]
+        offset = float(np.hypot(self.index.node_x[at] - x, self.index.node_y[at] - y))
+        cand = self.within(lat, lon, radius + offset + self.slack)
+        dist = np.array([lengths.get(int(n), math.inf) for n in self.walk_node[cand]], dtype=np.float64)
+        keep = dist < radius
+        cand, dist = cand[keep], dist[keep]
+        # ties keep catalogue order (line, then stop along it)
+        top = np.lexsort((cand, dist))[:k]
+        return cand[top], dist[top], len(cand)
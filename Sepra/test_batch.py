@@ -0,0 +1,59 @@
+import json
+import time
+
+import pytest
+
+import batch
+from batch import BatchJobs
+
+ROWS = [
+    {"row": k, "origin": f"o{k}", "destination": f"d{k}", "start_time": "8:20", "geometry": False}
+    for k in range(5)
+]
+
+def fake_route_row(task):
+    row = task[0]
+    return {"row": row["row"], "origin": row["origin"], "destination": row["destination"],
+            "start_time": row["start_time"], "time": row["row"]}
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    # routing needs the graphs; the job bookkeeping does not
+    monkeypatch.setattr(batch, "route_row", fake_route_row)
+    return BatchJobs(str(tmp_path), lambda texts: [(30.28, 57.07)] * len(texts), lambda text: 500)
+
+def wait_done(jobs, job_id, timeout=5):
+    # done is written just before the runner lets go of the lock
+    deadline = time.monotonic() + timeout
+    while jobs.status(job_id)["state"] != "done" or jobs.is_running(job_id):
+        assert time.monotonic() < deadline, jobs.status(job_id)
+        time.sleep(0.01)
+
+def test_interrupted_job_resumes_from_last_complete_line(jobs):
+    job_id = jobs.submit([dict(row) for row in ROWS])
+    wait_done(jobs, job_id)
+
+    # what a crash mid-job leaves behind: state still running, two complete
+    # lines and a half-written third
+    with open(jobs.path(job_id, "results.ndjson"), "rb") as f:
+        lines = f.readlines()
+    with open(jobs.path(job_id, "results.ndjson"), "wb") as f:
+        f.write(b"".join(lines[:2]) + lines[2][:7])
+    status = jobs.status(job_id)
+    jobs._write_status(job_id, {**status, "state": "running", "done": 2})
+
+    # a runner elsewhere still holds the job: it is running and can't be started
+    held = jobs._claim(job_id)
+    assert jobs.status(job_id)["state"] == "running"
+    assert not jobs.start(job_id)
+
+    # the runner is gone: the job shows as interrupted and resumes
+    held.close()
+    assert jobs.status(job_id)["state"] == "interrupted"
+    assert jobs.start(job_id)
+    wait_done(jobs, job_id)
+
+    status = jobs.status(job_id)
+    assert (status["done"], status["failed"]) == (len(ROWS), 0)
+    results = [json.loads(line) for line in jobs.stream(job_id, follow=False)]
+    assert [r["row"] for r in results] == [r["row"] for r in ROWS]
@@ -0,0 +1,52 @@
+import pytest
+
+from gazetteer import Gazetteer, GeocodeCache
+
+PLACES = [
+    ("میدان شهید باهنر", 30.2839, 57.0834),
+    ("دانشگاه شهید باهنر", 30.2566, 57.1066),
+    ("بازار گنج", 30.2906, 57.0781),
+    ("پارک ملت", 30.2786, 57.0617),
+    ("هتل پارس", 30.2700, 57.0560),
+    ("میدان آزادی", 30.2925, 57.0560),
+]
+
+@pytest.fixture
+def gazetteer():
+    return Gazetteer(PLACES)
+
+# unknown places close in spelling to a known one must go to the remote
+# geocoder, not resolve to the other place
+@pytest.mark.parametrize("query", [
+    "بیمارستان شهید باهنر",
+    "بازار وکیل",
+    "پارک مطهری",
+    "دانشگاه شهید بهشتی",
+    "هتل پارسیان",
+])
+def test_unknown_place_is_not_matched(gazetteer, query):
+    assert gazetteer.lookup(query) is None
+
+@pytest.mark.parametrize("query, name", [
+    ("ميدان آزادي", "میدان آزادی"),
+    ("میدان آزدی", "میدان آزادی"),
+    ("دانشگا شهید باهنر", "دانشگاه شهید باهنر"),
+    ("بازار گنج کرمان", "بازار گنج"),
+])
+def test_known_place_is_matched(gazetteer, query, name):
+    assert gazetteer.lookup(query)[0] == name
+
+def test_cache_entries_survive_reload(tmp_path):
+    path = str(tmp_path / "geocode_cache.json")
+    cache = GeocodeCache(path)
+    cache.put("بازار وکیل", (30.29, 57.08))
+    cache.put("جای ناموجود", None)
+    # a second process sharing the file appends to the same log
+    GeocodeCache(path).put("پارک مطهری", (30.27, 57.06))
+
+    reloaded = GeocodeCache(path)
+    assert reloaded.get("بازار وكيل") == (30.29, 57.08)
+    assert "جای ناموجود" in reloaded and reloaded.get("جای ناموجود") is None
+    assert reloaded.get("پارک مطهری") == (30.27, 57.06)
+    # loading folded the log into the file
+    assert (tmp_path / "geocode_cache.json.log").read_text(encoding="utf-8") == ""
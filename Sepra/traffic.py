@@ -0,0 +1,90 @@
+import ast
+import json
+import os
+import numpy as np
+
+# congestion as a table of factors per departure bucket (BUCKET_MIN minutes,
+# one day) and road class. an edge's travel time in a bucket is its free-flow
+# time times its class factor; engines turn the table into per-bucket weight
+# arrays once (snapshot.py packs the ride engine's), and a query only picks
+# the row for its departure bucket.
+
+BUCKET_MIN = 15
+BUCKETS = 24 * 60 // BUCKET_MIN
+DEFAULT = ""
+
+# per-bucket, per-road-class congestion factors; without the file the
+# city-wide traffic_factor is used for every road
+TRAFFIC_PROFILE = "Graphes/traffic_profile.json"
+
+def traffic_factor(h):
+    h = h//60
+    if 7 <= h < 9 and 13 <= h <= 15:
+        return 2
+    if 9 <= h < 16:
+        return 1.5
+    if 16 <= h < 19:
+        return 2.5
+    return 1.2
+
+def road_class(highway):
+    # osm highway tag as stored in graphml: None, a name, a list or a list's repr
+    if isinstance(highway, str) and highway.startswith("["):
+        highway = ast.literal_eval(highway)
+    if isinstance(highway, (list, tuple)):
+        highway = highway[0] if highway else None
+    return highway or DEFAULT
+
+class TrafficProfile:
+    def __init__(self, default, classes=None):
+        # default and every classes[name] hold one factor per bucket
+        self.names = [DEFAULT] + sorted(classes or {})
+        table = [default] + [classes[name] for name in self.names[1:]]
+        table = np.array(table, dtype=np.float64).T
+        if table.shape[0] != BUCKETS:
+            raise ValueError(f"a traffic profile needs {BUCKETS} factors per class, got {table.shape[0]}")
+        # buckets with the same factors share one row of weights
+        self.factors, rows = np.unique(table, axis=0, return_inverse=True)
+        self.rows = rows.reshape(-1).tolist()
+        self.default = table[:, 0].tolist()
+        self.uniform = bool((table == table[:, :1]).all())
+
+    @classmethod
+    def from_function(cls, factor):
+        # city-wide profile from a factor(minute) function
+        return cls([factor(b * BUCKET_MIN) for b in range(BUCKETS)])
+
+    def bucket(self, minute):
+        # departures past midnight stay in the last bucket of the day
+        return min(max(int(minute) // BUCKET_MIN, 0), BUCKETS - 1)
+
+    def row(self, minute):
+        return self.rows[self.bucket(minute)]
+
+    def factor(self, minute):
+        return self.default[self.bucket(minute)]
+
+    def class_ids(self, highways):
+        index = {name: i for i, name in enumerate(self.names)}
+        return np.array([index.get(road_class(h), 0) for h in highways], dtype=np.int64)
+
+    def edge_weights(self, lengths, highway, classes, speed):
+        """
+        seconds per edge for every distinct row of factors, shape
+        (rows, edges); highway holds each edge's position in classes and
+        row(minute) picks the row for a departure
+        """
+        free_flow = np.asarray(lengths, dtype=np.float64) / speed
+        return np.ascontiguousarray(self.factors[:, self.class_ids(classes)[highway]] * free_flow)
+
+def load_profile(path, fallback):
+    """
+    {"default": [...], "classes": {"primary": [...], ...}} with BUCKETS
+    factors each; the city-wide fallback(minute) when there is no file
+    """
+    if not os.path.exists(path):
+        return TrafficProfile.from_function(fallback)
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    default = data.get("default") or [fallback(b * BUCKET_MIN) for b in range(BUCKETS)]
+    return TrafficProfile(default, data.get("classes"))